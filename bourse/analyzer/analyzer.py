@@ -1,79 +1,175 @@
 import pandas as pd
+import numpy as np
 import os
 import timescaledb_model as tsdb
+import companies
+import indicators
+import metrics
+import staging
 import logging
 import bz2
-
-db = tsdb.TimescaleStockMarketModel('bourse', 'ricou', 'db', 'monmdp')        # inside docker
-#db = tsdb.TimescaleStockMarketModel('bourse', 'ricou', 'localhost', 'monmdp') # outside docker
+import multiprocessing
+import multiprocessing.pool
+import threading
+from collections import deque
+from itertools import islice
+
+# daystocks, hourstocks and weekstocks are continuous aggregates maintained by TimescaleDB
+CONTINUOUS_AGGREGATES = os.environ.get('BOURSE_CONTINUOUS_AGGREGATES', '0') == '1'
+# Chunk intervals of the stocks and daystocks hypertables
+CHUNK_INTERVALS = {'stocks': os.environ.get('BOURSE_CHUNK_INTERVAL', '30 days'),
+                   'daystocks': os.environ.get('BOURSE_DAY_CHUNK_INTERVAL', '365 days')}
+# Compress the chunks of the months already ingested
+COMPRESS = os.environ.get('BOURSE_COMPRESS', '1') == '1'
+# Chunks older than this (from now) are compressed by a TimescaleDB policy, none by default: the data
+# is historical, the policy would compress the chunks being backfilled
+COMPRESS_AFTER = os.environ.get('BOURSE_COMPRESS_AFTER', '') or None
+# Maximum number of connections of the model
+DB_POOL_SIZE = int(os.environ.get('BOURSE_DB_POOL_SIZE', 4))
+
+db = None
+
+def connect(model=None):
+    '''Write to model (e.g. benchmark.NullModel) or to the TimescaleDB database'''
+    global db
+    if model is not None:
+        db = model
+        return
+    options = dict(continuous_aggregates=CONTINUOUS_AGGREGATES, chunk_intervals=CHUNK_INTERVALS,
+                   compress=COMPRESS, compress_after=COMPRESS_AFTER, pool_size=DB_POOL_SIZE)
+    db = tsdb.TimescaleStockMarketModel('bourse', 'ricou', 'db', 'monmdp', **options)        # inside docker
+    #db = tsdb.TimescaleStockMarketModel('bourse', 'ricou', 'localhost', 'monmdp', **options) # outside docker
 
 logging.basicConfig()
 logging.getLogger('timescaledb_model').setLevel(logging.INFO)
 
 MAX_INT_VALUE = 2147483647
 
-comp_dict = {}
+# Number of processes decompressing and cleaning files, 1 means a single background thread
+NB_WORKERS = int(os.environ.get('BOURSE_WORKERS', os.cpu_count() or 1))
+# Number of files decoded ahead of the writer, this bounds the memory used by the pipeline
+PREFETCH = int(os.environ.get('BOURSE_PREFETCH', 2 * NB_WORKERS))
+# Number of rows accumulated before they are written to the database
+FLUSH_ROWS = int(os.environ.get('BOURSE_FLUSH_ROWS', 1000000))
+# Write stocks and daystocks with the binary COPY format instead of text
+BINARY_COPY = os.environ.get('BOURSE_BINARY_COPY', '1') == '1'
+# Fill the dayindicators table for the dashboard, month by month
+INDICATORS = os.environ.get('BOURSE_INDICATORS', '1') == '1'
+# Daily bars read before a month so that its first indicators are warmed up
+INDICATORS_LOOKBACK = pd.Timedelta(days=400)
+# Metrics exported every METRICS_INTERVAL seconds as JSON lines and as a Prometheus snapshot
+METRICS_JSONL = '/tmp/bourse_metrics.jsonl'
+METRICS_PROMETHEUS = '/tmp/bourse_metrics.prom'
+METRICS_INTERVAL = int(os.environ.get('BOURSE_METRICS_INTERVAL', 60))
+# Number of times a batch is retried after its transaction failed
+BATCH_RETRIES = int(os.environ.get('BOURSE_BATCH_RETRIES', 3))
+# Parquet copies of the cleaned files, read instead of the bz2 files by later runs (empty to disable)
+STAGING_DIR = os.environ.get('BOURSE_STAGING_DIR', '') if staging.available() else ''
+
+comp_index = companies.CompanyIndex()
 market_dict = {}
 tags_dict = {}
-
+files_done = set()
+files_failed = set()   # files which could not be decoded during this run
+current_month = None   # start of the month of the last batch, the months before are finished
+
+# Types of the columns of the ingested frames, applied as soon as a file is
+# read: the strings repeated on each row are categoricals and the numbers have
+# the size of their column in the database (stocks.value is a FLOAT4,
+# stocks.volume an INT).
+INGEST_SCHEMA = {
+    'filename': 'category',
+    'market': 'category',
+    'last': 'float32',
+    'volume': 'int32',
+    'suffix': 'int8',
+}
+# The symbols and names are unique within a file but repeated by every file:
+# the coordinator encodes them with categories shared by all the frames.
+VOCABULARY_COLUMNS = ['symbol', 'name']
+vocabularies = {}   # column -> CategoricalDtype, its categories only grow
+
+# code of the suffix column: the (c) or (s) seen after the price
+SUFFIXES = {'(c)': 1, '(s)': 2}
+
+# Most prices are already numbers: they are converted as they are, only the
+# strings lose their suffix and their thousands separators. A price which
+# still cannot be read is NaN.
 def clean_c_s(df):
-    df['last'] = df['last'].astype(str)
-    df['last'] = df['last'].str.replace(r'\((c|s)\)$', '', regex=True)
-    df['last'] = df['last'].str.replace(' ', '')
-    df['last'] = df['last'].astype(float)
-    return df
+    last = df['last']
+    values = pd.to_numeric(last, errors='coerce').to_numpy(dtype=float, copy=True)
+    suffix = np.zeros(len(df), dtype='int8')
+    # only the prices given as text are parsed again, the suffixes all have 3 characters
+    text = np.isnan(values) & last.notna().to_numpy()
+    if text.any():
+        # numpy string functions: the .str methods of pandas cost more than the parsing on a file
+        strings = last.to_numpy()[text].astype(str)
+        codes = np.zeros(len(strings), dtype='int8')
+        for string, code in SUFFIXES.items():
+            codes[np.strings.endswith(strings, string)] = code
+        # the suffixes are cut by clearing their characters, the strings end at the first one cleared
+        chars = strings.view('U1').reshape(len(strings), -1)
+        rows = np.flatnonzero(codes)
+        end = np.strings.str_len(strings[rows])
+        for i in range(1, 4):
+            chars[rows, end - i] = ''
+        values[text] = pd.to_numeric(np.strings.replace(strings, ' ', ''), errors='coerce')
+        suffix[text] = codes
+    return df.assign(last=values, suffix=suffix)
+
+def apply_schema(df, schema=INGEST_SCHEMA):
+    # column by column, DataFrame.astype(dict) is a few times slower on small frames
+    return df.assign(**{column: df[column].astype(dtype) for column, dtype in schema.items()
+                        if column in df and df[column].dtype != dtype})
+
+# The column as a categorical of the shared vocabulary of the column
+def encode_vocabulary(values, column):
+    dtype = vocabularies.get(column, pd.CategoricalDtype(pd.Index([], dtype=object)))
+    codes = dtype.categories.get_indexer(values)
+    new = (codes < 0) & values.notna().to_numpy()
+    if new.any():
+        # appended: the codes of the frames already encoded remain valid
+        dtype = pd.CategoricalDtype(dtype.categories.append(pd.Index(values[new].unique(), dtype=object)))
+        vocabularies[column] = dtype
+        codes = dtype.categories.get_indexer(values)
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype, validate=False), index=values.index)
+
+# pd.concat turns categoricals with different categories into objects, their
+# categories are merged instead
+def concat_frames(frames):
+    categorical = [column for column in frames[0]
+                   if all(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames)]
+    df = pd.concat([frame.drop(columns=categorical) for frame in frames], ignore_index=True)
+    for column in categorical:
+        if column in vocabularies:
+            # the codes of a vocabulary are the same in its latest categories
+            codes = np.concatenate([frame[column].cat.codes.to_numpy() for frame in frames])
+            df[column] = pd.Categorical.from_codes(codes, dtype=vocabularies[column])
+        else:
+            df[column] = pd.api.types.union_categoricals([frame[column] for frame in frames])
+    return df[frames[0].columns]
 
 def clean_data(df):
     df = df.drop_duplicates().dropna(subset=['last', 'volume'])
-    df = df[df['volume'] > 0]
-    return clean_c_s(df)
+    df = df[(df['volume'] > 0) & (df['volume'] <= MAX_INT_VALUE)]
+    df = clean_c_s(df)
+    return df[df['last'].notna()]
 
 # Add the data to the companies table
 def add_companies(df):
     # print(f'In add_companies')
 
-    unique_symbols_df = df.drop_duplicates(subset=['key']).reset_index()
-    unique_symbols = set(unique_symbols_df['symbol'])
+    # only the companies missing from comp_index, which mirrors the companies table
+    unknown = comp_index.get(df['mid'], df['symbol']) < 0
+    new_df = df.loc[unknown, ['name', 'mid', 'symbol']].drop_duplicates(subset=['symbol', 'mid'])
+    new_df = new_df[new_df['symbol'].notna() & new_df['mid'].notna()]
 
-    if len(unique_symbols) == 1:
-        # If there's only one element, use it directly without converting to a tuple
-        unique_symbols_str = str(unique_symbols).replace('{', '(').replace('}', ')')
-    else:
-        # If there are multiple elements, convert the list to a tuple
-        unique_symbols_tuple = tuple(unique_symbols)
-        unique_symbols_str = str(unique_symbols_tuple)
-    del unique_symbols
-
-    existing_symbols = set()
-    # Fetch existing symbols from the database in chunks
-    for chunk in db.df_query("SELECT DISTINCT symbol, mid FROM companies WHERE symbol IN %s", args=unique_symbols_str, chunksize=10000):
-        chunk['key'] = chunk['symbol'] + " " + chunk['mid'].astype(str)
-        existing_symbols.update(chunk['key'])
-    
-    index_total = next(db.df_query("SELECT count(*) FROM companies"))['count'][0]
-
-    unique_symbols_df = unique_symbols_df[~unique_symbols_df['key'].isin(existing_symbols)].reset_index()
-    del existing_symbols
-
-    unique_symbols_df['market_id'] = unique_symbols_df['market'].apply(lambda x: market_dict.get(x))
-
-    comp_df = pd.DataFrame({
-        "name": unique_symbols_df["name"].copy(),
-        "mid": unique_symbols_df["market_id"].copy(),
-        "symbol": unique_symbols_df["symbol"].copy(),
-        "symbol_nf": None,
-        "isin": None,
-        "reuters": None,
-        "boursorama": None,
-        "pea": None,
-        "sector": None
-    })
-
-    db.dataframe_to_sql(comp_df, 'companies', columns=list(comp_df.columns.values))
+    if new_df.empty:
+        return pd.DataFrame(columns=['symbol', 'mid', 'id'])
+    comp_df = db.register_companies(new_df['name'], new_df['mid'], new_df['symbol'])
+    metrics.inc('companies_added_total', len(comp_df))
 
-    comp_df['id'] = comp_df.index + index_total + 1
-
-    del unique_symbols_df
+    del new_df
 
     return comp_df
 
@@ -81,61 +177,42 @@ def add_companies(df):
 def add_stocks(df):
     # print(f'In add_stocks')
 
-    df['id'] = df['key'].apply(lambda x: comp_dict.get(x))
-
     stocks_df = pd.DataFrame({
         "date": df["date"].copy(),
-        "cid": df['id'],
+        "cid": df['cid'],
         "value": df["last"].copy(),
         "volume": df["volume"].copy(),
     })
 
     # stocks_df.loc[stocks_df['volume'] > MAX_INT_VALUE, 'volume'] = MAX_INT_VALUE
-    stocks_df = stocks_df[stocks_df['volume'] <= MAX_INT_VALUE]
+    stocks_df = stocks_df[(stocks_df['volume'] <= MAX_INT_VALUE) & (stocks_df['cid'] >= 0)]
 
-    db.dataframe_to_sql(stocks_df, 'stocks', columns=list(stocks_df.columns.values))
+    db.dataframe_to_sql(stocks_df, 'stocks', columns=list(stocks_df.columns.values), binary=BINARY_COPY)
 
     del stocks_df
 
-# Add the data to the daystocks table
-def add_daystocks(df, key):
+# Daily bars of all the companies of df at once, dated at midnight
+def daily_bars(df):
+    df = df.sort_values(['cid', 'date'], kind='stable')
+    # sorted once: the groups come in order and first/last are the open/close
+    bars = df.groupby(['cid', df['date'].dt.floor('D')], sort=False).agg(
+        open=('last', 'first'), close=('last', 'last'),
+        high=('last', 'max'), low=('last', 'min'),
+        volume=('volume', 'sum'),
+    ).reset_index()
+    bars = bars[['date', 'cid', 'open', 'close', 'high', 'low', 'volume']]
+    return bars[bars['volume'] <= MAX_INT_VALUE]
+
+# Add the data to the daystocks table, merged with the days already there
+def add_daystocks(df):
     # print(f'In add_daystocks')
-
-    daily_stats = df.resample('D', on='date').agg({
-            'last': ['first', 'last', 'max', 'min'],
-            'date': ['first'],
-            'symbol': ['first'],
-            'volume': ['sum']
-        }).reset_index()
-    
-    daily_stats.columns = ["", 'open', 'close', 'high', 'low', 'date', 'symbol', 'volume']
-    daily_stats['key'] = key
-
-    daily_stats['id'] = daily_stats['key'].apply(lambda x: comp_dict.get(x))
-    daily_stats.dropna(subset=['date'], inplace=True)
-
-    daystocks_df = pd.DataFrame({
-        "date": daily_stats["date"].copy(),
-        "cid": daily_stats["id"].copy(),
-        "open": daily_stats["open"].copy(),
-        "close": daily_stats["close"].copy(),
-        "high": daily_stats["high"].copy(),
-        "low": daily_stats["low"].copy(),
-        "volume": daily_stats["volume"].copy()
-    })
-
-    daystocks_df = daystocks_df[daystocks_df['volume'] <= MAX_INT_VALUE]
-
-    db.dataframe_to_sql(daystocks_df, 'daystocks', columns=list(daystocks_df.columns.values))
-
-    del daystocks_df
-    del daily_stats
+    db.merge_daystocks(daily_bars(df), binary=BINARY_COPY)
 
 def add_tags():
     # print(f'In add_tags')
     counts = []
     for key in market_dict.keys():
-        count = next(db.df_query(f"SELECT count(*) FROM companies WHERE mid = (SELECT id FROM markets where alias = '{key}')"))['count'][0]
+        count = next(db.df_query("SELECT count(*) FROM companies WHERE mid = (SELECT id FROM markets where alias = %s)", (key,)))['count'][0]
         counts.append(count)
 
     tags_df = pd.DataFrame({
@@ -167,35 +244,50 @@ def add_market(name):
 
 
 # Add the data to the file_done table
-def add_file_done(df):
+def add_file_done(filenames):
     # print(f'In add_file_done')
 
     filedone_df = pd.DataFrame({
-        "name": df["filename"].unique()
+        "name": filenames
     })
 
     db.dataframe_to_sql(filedone_df, 'file_done', columns=list(filedone_df.columns.values))
 
     del filedone_df
 
+# Add the batch to the ingest_journal table
+def add_journal(filenames, rows):
+    journal_df = pd.DataFrame({
+        "files": [len(filenames)],
+        "rows": [rows],
+        "first_file": [filenames[0]],
+        "last_file": [filenames[-1]]
+    })
+
+    db.dataframe_to_sql(journal_df, 'ingest_journal', columns=list(journal_df.columns.values))
+
+    del journal_df
+
 def make_companies_dict(df):
     # print(f'In make_companies_dict')
-    df['key'] = df['symbol'] + " " + df['mid'].astype(str)
-    comp_dict.update(df.set_index('key')['id'].to_dict())
+    comp_index.update(df['mid'], df['symbol'], df['id'])
     
+@metrics.timer('add_to_database')
 def add_to_database(df):
     print(f'In add_to_database')
+    metrics.inc('rows_total', len(df))
+
+    # one round trip for the new companies of the whole batch
+    comp_df = add_companies(df)
+    make_companies_dict(comp_df)
+    del comp_df
 
-    for _, group in df.groupby('filename'):
-        comp_df = add_companies(group)
-        make_companies_dict(comp_df)
-        add_stocks(group)
-        del comp_df
-        del group
+    # resolved once per batch, -1 for an unknown company
+    df['cid'] = comp_index.get(df['mid'], df['symbol'])
+    add_stocks(df)
 
-    for _, group in df.groupby('key'):
-        add_daystocks(group, group['key'].iloc[0])
-        del group
+    if not db.continuous_aggregates:
+        add_daystocks(df[df['cid'] >= 0])
     add_tags()
 
 def extract_date_filename_market(filepath):
@@ -205,31 +297,179 @@ def extract_date_filename_market(filepath):
     market = filename.split(" ")[0]
     return pd.to_datetime(date_str, format='%Y-%m-%d %H:%M:%S'), filename, market
 
-def load_and_clean_file(path):
-    with bz2.BZ2File(path, 'rb') as file:
-        df = pd.read_pickle(file)
+# Runs in the worker processes: it must not use the database nor the dictionaries
+@metrics.timer('read_file')
+def read_file(path, schema=INGEST_SCHEMA):
+    date, filename, market = extract_date_filename_market(path)
+    metrics.inc('files_total')
+    df = staging.load(STAGING_DIR, path, market, date) if STAGING_DIR else None
+    staged = df is not None
+    if staged:
+        metrics.inc('staged_files_total')
+    else:
+        with bz2.BZ2File(path, 'rb') as file:
+            df = pd.read_pickle(file)
         df.reset_index(drop=True, inplace=True)
-        date, filename, market = extract_date_filename_market(path)
-        df['date'] = date
-        df['filename'] = filename
-        df['market'] = market
-
-        for name in df['market'].drop_duplicates():
-            add_market(name)
-
-        df['key'] = df['symbol'] + " " + df['market'].apply(lambda x: str(market_dict.get(x)))
-
-        add_file_done(df)
-
-        return clean_data(df)
-
-def process_file(path, key):
-    if (len(path) > 0):
-        df = pd.concat([load_and_clean_file(p) for p in path])
-        if not df.empty:
-            add_to_database(df)
-        del df
+        cleaned = clean_data(df)
+        metrics.inc('bytes_total', os.path.getsize(path))
+        metrics.inc('rows_read_total', len(df))
+        metrics.inc('rows_dropped_total', len(df) - len(cleaned))
+        df = cleaned
+    df['date'] = date
+    df['filename'] = filename
+    df['market'] = market
+    if schema is not None:
+        df = apply_schema(df, schema)
+    if STAGING_DIR and not staged:
+        staging.store(STAGING_DIR, path, market, date, df)
+    return filename, market, date, df
+
+# read_file in a worker. A worker process gives its metrics to the coordinator,
+# a worker thread (make_pool(1)) already counts in the metrics of the coordinator.
+# A file which cannot be read gives None and is skipped for this run.
+def decode_file(path):
+    try:
+        result = read_file(path)
+    except Exception as e:
+        logging.exception(f"Cannot read {path}: {e}")
+        metrics.inc('files_failed_total')
+        result = None
+    # the tasks of a process pool run in the main thread of the worker
+    in_process = threading.current_thread() is threading.main_thread()
+    return result, metrics.collect() if in_process else None
+
+# Runs in the coordinator: it owns the market ids
+def register_file(filename, market, df):
+    add_market(market)
+    df['mid'] = np.int16(market_dict.get(market))   # markets.id is a SMALLINT
+    for column in VOCABULARY_COLUMNS:
+        df[column] = encode_vocabulary(df[column], column)
+    return df
 
+def load_and_clean_file(path):
+    filename, market, _, df = read_file(path)
+    return register_file(filename, market, df)
+
+# Decode stage: yields (path, read_file(path)) in order with at most `prefetch` files decoded ahead
+def decode_files(paths, pool, prefetch=PREFETCH):
+    paths = iter(paths)
+    pending = deque((p, pool.apply_async(decode_file, (p,))) for p in islice(paths, max(prefetch, 1)))
+    while pending:
+        path, result = pending.popleft()
+        with metrics.timer('decode_wait'):
+            result, worker_metrics = result.get()
+        if worker_metrics is not None:
+            metrics.merge(worker_metrics)
+        pending.extend((p, pool.apply_async(decode_file, (p,))) for p in islice(paths, 1))
+        yield path, result
+
+def reload_companies():
+    global comp_index
+    comp_index = companies.CompanyIndex()
+    init_comp_index()
+
+# One batch is one transaction: its file_done markers, companies, stocks, daystocks,
+# tags and journal entry are committed together, so that a restart resumes at
+# the first batch not committed, without duplicates.
+def write_batch(batch, filenames, retries=BATCH_RETRIES):
+    if len(filenames) == 0:
+        return
+    df = concat_frames(batch)
+    for attempt in range(retries + 1):
+        try:
+            with db.transaction():
+                add_file_done(filenames)
+                if not df.empty:
+                    add_to_database(df)
+                add_journal(filenames, len(df))
+            break
+        except Exception as e:
+            logging.exception(f"Batch {filenames[0]} .. {filenames[-1]} rolled back (attempt {attempt + 1}): {e}")
+            metrics.inc('batches_failed_total')
+            # the companies of the batch have been rolled back too
+            reload_companies()
+            if attempt == retries:
+                raise
+    files_done.update(filenames)
+    metrics.inc('batches_total')
+    if db.continuous_aggregates and not df.empty:
+        db.refresh_aggregates(df['date'].min(), df['date'].max())
+    if not df.empty:
+        finish_months(df['date'].min())
+    del df
+
+# The files are processed in chronological order: once a batch starts a new
+# month, the previous months will not get new rows. Their indicators are
+# computed and their chunks compressed.
+def finish_months(date):
+    global current_month
+    month = date.to_period('M').start_time
+    if current_month is not None and month <= current_month:
+        return
+    if INDICATORS:
+        # after a restart, the month before may have been left without its indicators
+        add_indicators(current_month or month - pd.DateOffset(months=1), month)
+    db.compress_before(month)
+    current_month = month
+
+# (Re)write the daily indicators of the days from start to end (excluded)
+@metrics.timer('add_indicators')
+def add_indicators(start, end=None):
+    # the bars of the lookback only warm the indicators up, they are not written
+    query = ("SELECT cid, date, open, high, low, close, volume, date >= %(start)s AS written "
+             "FROM daystocks WHERE date >= %(from)s")
+    if end is not None:
+        query += " AND date < %(end)s"
+    params = {'start': start, 'from': start - INDICATORS_LOOKBACK, 'end': end}
+    bars = list(db.df_query(query + " ORDER BY cid, date", params=params, chunksize=100000))
+    if len(bars) == 0:
+        return
+    bars = pd.concat(bars, ignore_index=True)
+
+    ind_df = indicators.compute(bars)
+    ind_df.insert(0, 'cid', bars['cid'])
+    ind_df.insert(0, 'date', bars['date'])
+    ind_df = ind_df[bars['written'].astype(bool)]
+
+    with db.transaction():
+        if end is None:
+            db.execute("DELETE FROM dayindicators WHERE date >= %s", (start,))
+        else:
+            db.execute("DELETE FROM dayindicators WHERE date >= %s AND date < %s", (start, end))
+        db.dataframe_to_sql(ind_df, 'dayindicators', columns=list(ind_df.columns.values), binary=BINARY_COPY)
+
+    del bars, ind_df
+
+# Write stage: flushes every `flush_rows` rows, but only between two days
+# so that a day is never split over two batches
+def process_files(paths, pool, flush_rows=FLUSH_ROWS):
+    batch, filenames, rows, day = [], [], 0, None
+    for path, result in decode_files(paths, pool):
+        if result is None:
+            files_failed.add(os.path.basename(path))
+            continue
+        filename, market, date, df = result
+        if rows >= flush_rows and date.normalize() != day:
+            write_batch(batch, filenames)
+            batch, filenames, rows = [], [], 0
+        day = date.normalize()
+        batch.append(register_file(filename, market, df))
+        filenames.append(filename)
+        rows += len(df)
+    write_batch(batch, filenames)
+
+def file_date(path):
+    # "<market> YYYY-MM-DD HH:MM:SS.bz2": the end of the name sorts chronologically
+    return os.path.basename(path).split(" ", 1)[1]
+
+def process_all_files(file_paths, pool):
+    paths = sorted((p for files in file_paths.values() for p in files), key=file_date)
+    process_files(paths, pool)
+    # the last month is not finished, its indicators are written again with it
+    if INDICATORS and current_month is not None:
+        add_indicators(current_month)
+
+@metrics.timer('load_all_files')
 def load_all_files():
     print(f'In load_all_files')
 
@@ -245,52 +485,73 @@ def load_all_files():
             file_paths_by_year_month[key] = []
 
         if os.path.isdir(year_path):
-            for file_name in os.listdir(year_path):
-                if not db.is_file_done(file_name):
-                    year_month = "-".join(file_name.split()[1].split("-")[:2])  # Extract year-month from file name
-                    file_paths_by_year_month[year_month].append(os.path.join(year_path, file_name))
+            # diff the listing against the in-memory set, no query per file
+            for file_name in sorted(set(os.listdir(year_path)) - files_done - files_failed):
+                year_month = "-".join(file_name.split()[1].split("-")[:2])  # Extract year-month from file name
+                file_paths_by_year_month[year_month].append(os.path.join(year_path, file_name))
 
     print(f"Total number of files to process: {sum(len(files) for files in file_paths_by_year_month.values())}")
 
     return file_paths_by_year_month
 
-def init_comp_dict():
+def init_comp_index():
     df = list(db.df_query("SELECT symbol, mid, id FROM companies"))
     df = pd.concat(df, ignore_index=True)
-    df['key'] = df['symbol'] + " " + df['mid'].astype(str)
-    comp_dict.update(df.set_index('key')['id'].to_dict())
+    comp_index.update(df['mid'], df['symbol'], df['id'])
 
 def init_market_dict():
     df = list(db.df_query("SELECT * FROM markets"))
     df = pd.concat(df, ignore_index=True)
     market_dict.update(df.set_index('alias')['id'].to_dict())
 
+def init_files_done():
+    files_done.update(db.get_files_done())
+
 def init_tags_dict():
     df = list(db.df_query("SELECT * FROM tags"))
     df = pd.concat(df, ignore_index=True)
     tags_dict.update(df.set_index('name')['value'].to_dict())
 
-def fill_database():
+def make_pool(workers):
+    if workers <= 1:
+        # bz2 releases the GIL, a thread is enough to overlap decoding and writing
+        return multiprocessing.pool.ThreadPool(1)
+    # fork so that the workers do not open their own connection to the database
+    return multiprocessing.get_context('fork').Pool(workers, initializer=metrics.reset)
+
+def fill_database(workers=NB_WORKERS):
 
-    init_comp_dict()
+    init_comp_index()
     init_market_dict()
     init_tags_dict()
+    init_files_done()
 
-    file_paths = load_all_files()
-    while sum(len(files) for files in file_paths.values()) != 0:
-        logging.info("Starting to process files")
+    last_batch = db.last_journal_entry()
+    if last_batch is not None:
+        logging.info(f"Resuming after batch {last_batch['id']} ({last_batch['last_file']}, "
+                     f"committed at {last_batch['committed_at']})")
 
-        try:
-            for key in file_paths:
-                process_file(file_paths[key], key)
-        except Exception as e:
-           print(f"There has been an error: {e}")
+    pool = make_pool(workers)
+    logging.info(f"Using {workers} worker(s)")
+    stop_metrics = metrics.start_export(METRICS_JSONL, METRICS_PROMETHEUS, METRICS_INTERVAL)
 
+    try:
+        # loop for the files which arrived during the run, a failed batch stops the
+        # ingestion and the next run starts again from this batch
         file_paths = load_all_files()
+        while sum(len(files) for files in file_paths.values()) != 0:
+            logging.info("Starting to process files")
+            process_all_files(file_paths, pool)
+            file_paths = load_all_files()
+    finally:
+        pool.terminate()
+        pool.join()
+        stop_metrics()
 
 if __name__ == '__main__':
     logging.debug(f'In MAIN')
 
+    connect()
     fill_database()
 
     print("Done")
\ No newline at end of file
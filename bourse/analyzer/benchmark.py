@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Benchmarks of the ingestion.
+
+  python3 benchmark.py copy [--rows N] [--host HOST]
+  python3 benchmark.py clean [--rows N]
+  python3 benchmark.py export [--rows N] [--host HOST]
+  python3 benchmark.py ingest [--days D] [--symbols S] [--workers W] [--host HOST]
+  python3 benchmark.py memory [--days D] [--symbols S]
+
+  copy:   text (CSV) against binary COPY for the stocks table. Without --host
+          only the encoding is measured, with --host the data is also written
+          to a temporary copy of the stocks table.
+  clean:  the cleaning of the prices (clean_c_s) against the former regex
+          version, on one file and on --rows rows.
+  export: decoding of the binary COPY stream of --rows stocks rows into Arrow
+          (export.BatchWriter). With --host, df_query against export.to_table
+          on a temporary copy of the stocks table.
+  ingest: generates synthetic boursorama files and times each stage of the
+          analyzer. Without --host the data goes to a NullModel which only
+          encodes it for COPY, so it runs without any database. With --host
+          the synthetic data is really written: use a scratch database.
+  memory: reads synthetic files as one batch without and with the ingest
+          schema (analyzer.INGEST_SCHEMA), each in a new process, and gives
+          the size of the batch and the growth of the peak RSS.
+
+  Each line gives the time, the throughput and the peak RSS of the process so
+  far (the RSS high-water mark cannot be reset, so it only grows).
+'''
+
+import argparse
+import bz2
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from contextlib import contextmanager
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+import pgcopy
+
+STOCKS_OIDS = [pgcopy.TIMESTAMPTZ, 21, 700, 23]
+TABLE_OIDS = {
+    'stocks': STOCKS_OIDS,
+    'daystocks': [pgcopy.TIMESTAMPTZ, 21, 700, 700, 700, 700, 23],
+}
+MARKETS = ['amsterdam', 'compA', 'compB']
+
+
+def timeit(function, *args, repeat=3):
+    '''Return the best time of repeat calls of function'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def peak_rss():
+    '''Peak resident set size of the process, in bytes'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def current_rss():
+    '''Resident set size of the process, in bytes (Linux only)'''
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def report(name, rows, seconds, nbytes=None):
+    size = '' if nbytes is None else f'  {nbytes / 2**20:10.1f} MiB'
+    print(f'{name:30s} {seconds:8.3f} s  {rows / seconds:14,.0f} rows/s'
+          f'  peak RSS {peak_rss() / 2**20:8.1f} MiB{size}')
+
+def measure(name, rows, function, *args):
+    '''Run function once, report it and return its result'''
+    start = time.perf_counter()
+    result = function(*args)
+    report(name, rows, time.perf_counter() - start)
+    return result
+
+# ----------------------------- synthetic data ---------------------------------
+
+def make_stocks(rows, companies=5000, seed=0):
+    '''A stocks dataframe with the columns and types of add_stocks'''
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2020-01-02 09:00:00')
+    return pd.DataFrame({
+        "date": start + pd.to_timedelta(rng.integers(0, 8 * 3600, rows) // 600 * 600, unit='s'),
+        "cid": rng.integers(1, companies, rows).astype(float),
+        "value": rng.lognormal(3, 1, rows).round(3),
+        "volume": rng.integers(1, 1000000, rows).astype(float),
+    })
+
+def make_boursorama(symbols, rng):
+    '''One file of quotes as pickled by the boursorama spider: prices are floats
+    or strings with a "(c)"/"(s)" suffix and thousands separators, some volumes
+    are 0 and some rows are duplicated.'''
+    last = rng.lognormal(3, 1.5, len(symbols)).round(2)
+    text = pd.Series([f'{v:,.2f}'.replace(',', ' ') for v in last], dtype=object)
+    suffix = rng.random(len(symbols))
+    text[suffix < 0.05] += '(c)'
+    text[(suffix >= 0.05) & (suffix < 0.08)] += '(s)'
+    last = pd.Series(last, dtype=object)
+    as_text = rng.random(len(symbols)) < 0.3
+    last[as_text] = text[as_text]
+    df = pd.DataFrame({
+        'symbol': symbols,
+        'last': last,
+        'volume': rng.integers(0, 100000, len(symbols)) * (rng.random(len(symbols)) > 0.1),
+        'name': [f'Company {s[3:]}' for s in symbols],
+    })
+    return pd.concat([df, df.sample(frac=0.02, random_state=0)]).set_index('symbol', drop=False)
+
+def make_files(folder, days, symbols, markets=MARKETS, seed=0):
+    '''Write the files of days trading days, one every 10 minutes from 9:00 to
+    17:30, as "<folder>/<year>/<market> YYYY-MM-DD HH:MM:SS.bz2"'''
+    rng = np.random.default_rng(seed)
+    paths = []
+    for day in pd.bdate_range('2020-01-02', periods=days):
+        for market in markets:
+            names = [f'1r{market[0].upper()}{i:04d}' for i in range(symbols)]
+            for date in pd.date_range(day + pd.Timedelta('9h'), day + pd.Timedelta('17h30min'), freq='10min'):
+                year = os.path.join(folder, str(date.year))
+                os.makedirs(year, exist_ok=True)
+                path = os.path.join(year, f'{market} {date:%Y-%m-%d %H:%M:%S}.bz2')
+                make_boursorama(names, rng).to_pickle(path, compression='bz2')
+                paths.append(path)
+    return paths
+
+# ----------------------------- null database ----------------------------------
+
+class NullModel:
+    '''Stand-in for TimescaleStockMarketModel: the dataframes are encoded as for
+    COPY (so the formatting cost is measured) and dropped.'''
+
+    continuous_aggregates = False
+
+    def __init__(self):
+        self.rows = {}
+
+    def dataframe_to_sql(self, df, table_name, columns=None, binary=False):
+        if binary and table_name in TABLE_OIDS:
+            for _ in pgcopy.encode(df, TABLE_OIDS[table_name]):
+                pass
+        else:
+            df.to_csv(StringIO(), sep='\t', index=False, header=False, na_rep='\\N')
+        self.rows[table_name] = self.rows.get(table_name, 0) + len(df)
+
+    def merge_daystocks(self, df, binary=False):
+        self.dataframe_to_sql(df, 'daystocks', binary=binary)
+
+    def df_query(self, query, args=None, chunksize=1000, **kwargs):
+        if 'count(*)' in query:
+            return iter([pd.DataFrame({'count': [self.rows.get('companies', 0)]})])
+        return iter([])
+
+    def register_companies(self, names, mids, symbols):
+        start = self.rows.get('companies', 0) + 1
+        self.rows['companies'] = start - 1 + len(symbols)
+        return pd.DataFrame({'symbol': list(symbols), 'mid': list(mids),
+                             'id': range(start, start + len(symbols))})
+
+    def raw_query(self, query, args=None, cursor=None):
+        return []
+
+    def execute(self, query, args=None, cursor=None, commit=False):
+        pass
+
+    def get_files_done(self):
+        return set()
+
+    def refresh_aggregates(self, start, end):
+        pass
+
+    def compress_before(self, date):
+        pass
+
+    def commit(self):
+        pass
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    def last_journal_entry(self):
+        return None
+
+# ----------------------------- benchmarks -------------------------------------
+
+def encode_csv(df):
+    buffer = StringIO()
+    df.to_csv(buffer, sep='\t', index=False, header=False, na_rep='\\N')
+    return buffer
+
+def encode_binary(df):
+    return b''.join(pgcopy.encode(df, STOCKS_OIDS, 'Europe/Paris'))
+
+def bench_copy(rows, host=None):
+    df = make_stocks(rows)
+    report('encode text', rows, timeit(encode_csv, df), len(encode_csv(df).getvalue()))
+    report('encode binary', rows, timeit(encode_binary, df), len(encode_binary(df)))
+    if host is None:
+        return
+
+    import timescaledb_model as tsdb
+    db = tsdb.TimescaleStockMarketModel('bourse', 'ricou', host, 'monmdp')
+    # not a TEMP table: each call may use another connection of the pool
+    db.execute('CREATE UNLOGGED TABLE bench_stocks (LIKE stocks);')
+    try:
+        columns = list(df.columns.values)
+        for name, binary in (('copy text', False), ('copy binary', True)):
+            report(name, rows, timeit(db.dataframe_to_sql, df, 'bench_stocks', columns, binary))
+            db.execute('TRUNCATE bench_stocks;')
+    finally:
+        db.execute('DROP TABLE bench_stocks;')
+
+def bench_export(rows, host=None):
+    import export
+
+    df = make_stocks(rows)
+    data = encode_binary(df)
+    size = pgcopy.record_dtype(STOCKS_OIDS).itemsize
+    # as psycopg2 does, one write per row
+    parts = [data[:19]] + [data[i:i + size] for i in range(19, len(data) - 2, size)] + [data[-2:]]
+    schema = export.pa.schema([(c, export.arrow_type(oid, 'UTC')) for c, oid in zip(df.columns, STOCKS_OIDS)])
+
+    def decode():
+        batches = []
+        writer = export.BatchWriter(schema, STOCKS_OIDS, batches.append)
+        for part in parts:
+            writer.write(part)
+        writer.close()
+        return batches
+    report('decode binary COPY to Arrow', rows, timeit(decode), len(data))
+    if host is None:
+        return
+
+    import timescaledb_model as tsdb
+    db = tsdb.TimescaleStockMarketModel('bourse', 'ricou', host, 'monmdp')
+    db.execute('CREATE UNLOGGED TABLE bench_stocks (LIKE stocks);')
+    try:
+        db.dataframe_to_sql(df, 'bench_stocks', list(df.columns), binary=True)
+        report('df_query', rows, timeit(lambda: db.df_query('SELECT * FROM bench_stocks ORDER BY cid, date', chunksize=None)))
+        report('export.to_table', rows, timeit(export.to_table, db, 'bench_stocks'))
+    finally:
+        db.execute('DROP TABLE bench_stocks;')
+
+def clean_c_s_regex(df):
+    '''clean_c_s before the numeric fast path, for comparison'''
+    df['last'] = df['last'].astype(str)
+    df['last'] = df['last'].str.replace(r'\((c|s)\)$', '', regex=True)
+    df['last'] = df['last'].str.replace(' ', '')
+    df['last'] = df['last'].astype(float)
+    return df
+
+def bench_clean(rows):
+    import analyzer
+
+    rng = np.random.default_rng(0)
+    symbols = [f'1rP{i:05d}' for i in range(rows)]
+    # a file of boursorama has about 1000 quotes
+    for name, size in (('one file', 1000), (f'{rows} rows', rows)):
+        df = make_boursorama(symbols[:size], rng).reset_index(drop=True)
+        regex = timeit(lambda: clean_c_s_regex(df.copy()))
+        fast = timeit(lambda: analyzer.clean_c_s(df.copy()))
+        report(f'clean_c_s regex ({name})', len(df), regex)
+        report(f'clean_c_s ({name})', len(df), fast)
+        assert np.allclose(clean_c_s_regex(df.copy())['last'], analyzer.clean_c_s(df.copy())['last'])
+        print(f'speedup {regex / fast:.1f}x')
+
+def daily_bars_resample(df):
+    '''daily_bars as before, one resample per company, for comparison'''
+    bars = []
+    for cid, group in df.groupby('cid'):
+        stats = group.resample('D', on='date').agg({'last': ['first', 'last', 'max', 'min'], 'volume': ['sum']})
+        stats.columns = ['open', 'close', 'high', 'low', 'volume']
+        bars.append(stats.dropna(subset=['open']).assign(cid=cid).reset_index())
+    return pd.concat(bars)
+
+def read_batch(paths, schema):
+    '''Read paths as one batch, return its rows, its size and the growth of the peak RSS'''
+    import analyzer
+
+    start = current_rss()
+    frames = []
+    for path in paths:
+        filename, market, _, df = analyzer.read_file(path, schema)
+        frames.append(df if schema is None else analyzer.register_file(filename, market, df))
+    df = analyzer.concat_frames(frames)
+    return len(df), df.memory_usage(deep=True).sum(), peak_rss() - start
+
+def bench_memory(days, symbols):
+    import analyzer
+    analyzer.connect(NullModel())
+
+    # forked before the files are generated, so that they start small
+    context = multiprocessing.get_context('fork')
+    pools = {name: context.Pool(1) for name in ('objects', 'ingest schema')}
+    with tempfile.TemporaryDirectory(prefix='boursorama') as folder:
+        paths = make_files(folder, days, symbols)
+        print(f'{len(paths)} files')
+        for (name, pool), schema in zip(pools.items(), (None, analyzer.INGEST_SCHEMA)):
+            rows, nbytes, rss = pool.apply(read_batch, (paths, schema))
+            pool.close()
+            print(f'{name:15s} {rows:12,} rows  batch {nbytes / 2**20:8.1f} MiB  peak RSS +{rss / 2**20:8.1f} MiB')
+
+def bench_ingest(days, symbols, workers, host=None):
+    import analyzer
+
+    if host is None:
+        analyzer.connect(NullModel())
+    else:
+        import timescaledb_model as tsdb
+        analyzer.connect(tsdb.TimescaleStockMarketModel('bourse', 'ricou', host, 'monmdp'))
+        analyzer.init_comp_index()
+        analyzer.init_market_dict()
+
+    with tempfile.TemporaryDirectory(prefix='boursorama') as folder:
+        start = time.perf_counter()
+        paths = make_files(folder, days, symbols)
+        print(f'{len(paths)} files generated in {time.perf_counter() - start:.1f} s')
+
+        def decompress(paths):
+            frames = []
+            for path in paths:
+                with bz2.BZ2File(path, 'rb') as file:
+                    frames.append(pd.read_pickle(file))
+            return frames
+
+        frames = decompress(paths[:1])
+        rows = len(paths) * len(frames[0])
+        frames = measure('decompress', rows, decompress, paths)
+        measure('clean_data', rows, lambda: [analyzer.clean_data(df.reset_index(drop=True)) for df in frames])
+        del frames
+
+        files = measure('read_file', rows, lambda: [analyzer.read_file(p) for p in paths])
+        df = analyzer.concat_frames([analyzer.register_file(filename, market, df) for filename, market, _, df in files])
+        del files
+        rows = len(df)
+
+        measure('add_companies', rows, lambda: analyzer.make_companies_dict(analyzer.add_companies(df)))
+        df['cid'] = analyzer.comp_index.get(df['mid'], df['symbol'])
+        measure('add_stocks', rows, analyzer.add_stocks, df)
+        measure('daily bars (resample per cid)', rows, daily_bars_resample, df)
+        measure('daily_bars', rows, analyzer.daily_bars, df)
+        measure('add_daystocks', rows, analyzer.add_daystocks, df)
+
+        stocks = pd.DataFrame({'date': df['date'], 'cid': df['cid'], 'value': df['last'], 'volume': df['volume']})
+        del df
+        for name, binary in (('dataframe_to_sql text', False), ('dataframe_to_sql binary', True)):
+            measure(name, rows, analyzer.db.dataframe_to_sql, stocks, 'stocks', list(stocks.columns), binary)
+        del stocks
+
+        pool = analyzer.make_pool(workers)
+        try:
+            measure(f'pipeline ({workers} workers)', rows, analyzer.process_files, paths, pool)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    import metrics
+    for key, value in sorted(metrics.snapshot()['counters'].items()):
+        print(f'{key:40s} {value:14,}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of the ingestion')
+    parser.add_argument('benchmark', choices=['copy', 'clean', 'export', 'ingest', 'memory'])
+    parser.add_argument('--rows', type=int, default=1000000, help='rows for copy, clean and export')
+    parser.add_argument('--days', type=int, default=2, help='trading days of files for ingest and memory')
+    parser.add_argument('--symbols', type=int, default=500, help='symbols per market for ingest and memory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='workers for ingest')
+    parser.add_argument('--host', help='TimescaleDB host, no database is used if not given')
+    args = parser.parse_args()
+
+    if args.benchmark == 'copy':
+        bench_copy(args.rows, args.host)
+    elif args.benchmark == 'clean':
+        bench_clean(args.rows)
+    elif args.benchmark == 'export':
+        bench_export(args.rows, args.host)
+    elif args.benchmark == 'memory':
+        bench_memory(args.days, args.symbols)
+    else:
+        bench_ingest(args.days, args.symbols, args.workers, args.host)
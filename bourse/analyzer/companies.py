@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Array backed mapping (symbol, market id) -> company id.
+
+  Symbols are numbered once in a vocabulary (an Index, the code of a symbol is
+  its position) and a company is identified by the int64 key
+  symbol code << 16 | market id. Resolving a column of symbols therefore costs
+  one lookup per distinct symbol and integer operations per row, instead of a
+  string concatenation and a dict lookup per row.
+
+  >>> index = CompanyIndex()
+  >>> index.update([1, 1, 2], ['AI', 'OR', 'AI'], [10, 11, 12])
+  >>> index.get(pd.Series([2, 1, 1, 3]), pd.Series(['AI', 'AI', 'XX', 'AI']))
+  array([12, 10, -1, -1])
+  >>> len(index)
+  3
+  >>> CompanyIndex().get([1], ['AI'])
+  array([-1])
+'''
+
+import numpy as np
+import pandas as pd
+
+MID_BITS = 16   # markets.id is a SMALLINT
+
+
+class CompanyIndex:
+
+    def __init__(self):
+        self.__symbols = pd.Index([], dtype=object)   # vocabulary of the symbols
+        self.__keys = pd.Index([], dtype='int64')     # symbol code << MID_BITS | mid
+        self.__ids = np.empty(0, dtype='int64')       # company id of each key
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def symbol_codes(self, symbols, add=False):
+        '''Return the code of each symbol, -1 if unknown (or NaN).
+        With add, unknown symbols are appended to the vocabulary.'''
+        if isinstance(symbols, pd.Series) and isinstance(symbols.dtype, pd.CategoricalDtype):
+            codes, uniques = symbols.cat.codes.to_numpy(), symbols.cat.categories
+        else:
+            codes, uniques = pd.factorize(np.asarray(symbols, dtype=object))
+        vocabulary = self.__symbols.get_indexer(uniques)
+        if add and (vocabulary < 0).any():
+            self.__symbols = self.__symbols.append(pd.Index(uniques[vocabulary < 0], dtype=object))
+            vocabulary = self.__symbols.get_indexer(uniques)
+        return np.where(codes < 0, -1, vocabulary[codes])
+
+    def encode(self, mids, symbols, add=False):
+        '''Return the key of each (mid, symbol), -1 if the symbol is unknown'''
+        codes = self.symbol_codes(symbols, add)
+        mids = np.asarray(mids, dtype='int64')
+        return np.where(codes < 0, -1, (codes << MID_BITS) | mids)
+
+    def get(self, mids, symbols):
+        '''Return the company id of each (mid, symbol), -1 if unknown'''
+        keys = self.encode(mids, symbols)
+        positions = self.__keys.get_indexer(keys)
+        positions[keys < 0] = -1
+        ids = np.full(len(positions), -1, dtype='int64')
+        ids[positions >= 0] = self.__ids[positions[positions >= 0]]
+        return ids
+
+    def update(self, mids, symbols, ids):
+        new = pd.Series(np.asarray(ids, dtype='int64'), index=self.encode(mids, symbols, add=True))
+        new = new[(new.index >= 0) & ~new.index.duplicated(keep='last')]
+        # new values replace the old ones
+        known = self.__keys.isin(new.index)
+        self.__keys = self.__keys[~known].append(new.index)
+        self.__ids = np.concatenate([self.__ids[~known], new.to_numpy()])
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
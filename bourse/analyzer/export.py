@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Read-only export of the tables to Arrow and Parquet, for the analyses which
+  need many rows (pd.read_sql creates Python objects for every value).
+
+  A selection (table, companies, dates) is sent as COPY ... TO STDOUT in the
+  binary format and the stream is decoded with numpy (pgcopy.decode) by
+  chunks of about chunk_bytes, each chunk becoming an Arrow record batch. The
+  COPY runs in a thread which hands the batches over through a queue of
+  prefetch batches: when the consumer is slower, the COPY waits, so the memory
+  stays bounded whatever the size of the selection.
+
+  record_batches() yields the batches, to_table() collects them and
+  to_parquet() writes them as a dataset partitioned by month, as staging.py.
+
+  python3 export.py stocks --cids 1 2 --start 2020-01-01 --end 2021-01-01 --output /tmp/stocks
+
+  Only the tables with fixed size types can be exported (see pgcopy.TYPES).
+  pyarrow is needed.
+'''
+
+import argparse
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+from psycopg2 import sql
+
+import pgcopy
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute
+    import pyarrow.dataset
+except ImportError:
+    pa = None
+
+CHUNK_BYTES = 16 * 2**20    # of COPY data per record batch
+PREFETCH = 2                # record batches decoded ahead of the consumer
+FLOATS = (700, 701)
+# microseconds between the epochs of Arrow (1970) and PostgreSQL (2000)
+EPOCH_OFFSET = int((pgcopy.POSTGRES_EPOCH - np.datetime64('1970-01-01T00:00:00', 'us')).astype('i8'))
+
+
+def arrow_type(oid, timezone):
+    return {
+        16: pa.bool_(),
+        20: pa.int64(),
+        21: pa.int16(),
+        23: pa.int32(),
+        700: pa.float32(),
+        701: pa.float64(),
+        pgcopy.TIMESTAMP: pa.timestamp('us'),
+        pgcopy.TIMESTAMPTZ: pa.timestamp('us', tz=timezone),
+    }[oid]
+
+def describe(db, table, columns=None):
+    '''Return the columns of table (all by default) and their type oids'''
+    with db.connection() as connection, connection.cursor() as cursor:
+        cursor.execute(sql.SQL('SELECT * FROM {} LIMIT 0;').format(sql.Identifier(table)))
+        types = {d.name: d.type_code for d in cursor.description}
+    columns = list(types) if columns is None else list(columns)
+    unknown = [column for column in columns if column not in types]
+    if unknown:
+        raise ValueError(f'No column {", ".join(unknown)} in {table}')
+    oids = [types[column] for column in columns]
+    if not pgcopy.supports(oids):
+        raise ValueError(f'Cannot export {table}: only the types {sorted(pgcopy.TYPES)} are supported')
+    return columns, oids
+
+def copy_query(table, columns, oids, cids=None, start=None, end=None):
+    '''COPY of the selection and its parameters'''
+    # NaN instead of NULL: the tuples without NULL are decoded together
+    fields = [sql.SQL("coalesce({0}, 'NaN') AS {0}").format(sql.Identifier(column)) if oid in FLOATS
+              else sql.Identifier(column) for column, oid in zip(columns, oids)]
+    conditions, params = [sql.SQL('TRUE')], {}
+    if cids is not None:
+        conditions.append(sql.SQL('cid = ANY(%(cids)s)'))
+        params['cids'] = [int(cid) for cid in cids]
+    if start is not None:
+        conditions.append(sql.SQL('date >= %(start)s'))
+        params['start'] = start
+    if end is not None:
+        conditions.append(sql.SQL('date < %(end)s'))
+        params['end'] = end
+    query = sql.SQL('COPY (SELECT {} FROM {} WHERE {} ORDER BY cid, date) TO STDOUT (FORMAT binary)').format(
+        sql.SQL(', ').join(fields), sql.Identifier(table), sql.SQL(' AND ').join(conditions))
+    return query, params
+
+
+class BatchWriter:
+    '''
+    File-like object for cursor.copy_expert: decodes the COPY stream by chunks
+    of about chunk_bytes and gives each record batch to emit.
+    '''
+
+    def __init__(self, schema, oids, emit, chunk_bytes=CHUNK_BYTES):
+        self.schema = schema
+        self.oids = oids
+        self.emit = emit
+        self.chunk_bytes = chunk_bytes
+        self.parts, self.size = [], 0
+        self.header = True
+
+    def write(self, data):
+        # psycopg2 writes each row of the COPY on its own
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_bytes:
+            self.flush()
+
+    def flush(self):
+        data = b''.join(self.parts)
+        start = 0
+        if self.header:
+            # signature, flags and the length of the header extension
+            if len(data) < 19:
+                return
+            start = 19 + struct.unpack_from('>i', data, 15)[0]
+            self.header = False
+        view, columns = memoryview(data), []
+        while True:
+            decoded, size = pgcopy.decode(view[start:], self.oids)
+            if decoded is None:
+                break
+            columns.append(decoded)
+            start += size
+        view.release()
+        self.parts, self.size = [data[start:]], len(data) - start
+        if columns:
+            self.emit(self.batch(columns))
+
+    def close(self):
+        self.flush()
+        if self.header or b''.join(self.parts) != pgcopy.TRAILER:
+            raise ValueError('Truncated COPY stream')
+
+    def batch(self, columns):
+        arrays = []
+        for i, (field, oid) in enumerate(zip(self.schema, self.oids)):
+            values = np.concatenate([column[i][0] for column in columns])
+            nulls = np.concatenate([column[i][1] for column in columns])
+            if oid in (pgcopy.TIMESTAMP, pgcopy.TIMESTAMPTZ):
+                values = values + EPOCH_OFFSET
+            elif oid in FLOATS:
+                nulls |= np.isnan(values)
+            arrays.append(pa.array(values, type=field.type, mask=nulls))
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+
+def selection(db, table, cids=None, start=None, end=None, columns=None):
+    '''COPY query, parameters, type oids and Arrow schema of a selection'''
+    columns, oids = describe(db, table, columns)
+    schema = pa.schema([(column, arrow_type(oid, db.timezone())) for column, oid in zip(columns, oids)])
+    query, params = copy_query(table, columns, oids, cids, start, end)
+    return query, params, oids, schema
+
+def stream(db, query, params, oids, schema, chunk_bytes=CHUNK_BYTES, prefetch=PREFETCH):
+    '''Yield the record batches of the COPY query, run in a read-only transaction of its own thread'''
+    batches = queue.Queue(prefetch)
+    stop = threading.Event()
+    running = []    # the connection of the COPY while it runs, to cancel it
+    lock = threading.Lock()
+
+    def put(item):
+        # gives up when the consumer is gone
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def copy():
+        try:
+            with db.connection() as connection, connection.cursor() as cursor:
+                with lock:
+                    running.append(connection)
+                try:
+                    cursor.execute('SET TRANSACTION READ ONLY;')
+                    writer = BatchWriter(schema, oids, put, chunk_bytes)
+                    cursor.copy_expert(cursor.mogrify(query, params).decode(), writer)
+                    writer.close()
+                finally:
+                    # back to the pool, another thread may use it
+                    with lock:
+                        running.clear()
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=copy, name='export', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = batches.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        with lock:
+            for connection in running:
+                connection.cancel()
+        thread.join()
+
+def record_batches(db, table, cids=None, start=None, end=None, columns=None, chunk_bytes=CHUNK_BYTES):
+    '''
+    Yield the rows of table as Arrow record batches, sorted by cid and date.
+
+    :param db: a TimescaleStockMarketModel
+    :param cids: ids of the companies, all of them if None
+    :param start: first date included, end: first date excluded
+    :param columns: columns of the table, all of them if None
+    '''
+    query, params, oids, schema = selection(db, table, cids, start, end, columns)
+    yield from stream(db, query, params, oids, schema, chunk_bytes)
+
+def to_table(db, table, cids=None, start=None, end=None, columns=None):
+    '''The rows of record_batches() as one Arrow table (in memory)'''
+    query, params, oids, schema = selection(db, table, cids, start, end, columns)
+    return pa.Table.from_batches(list(stream(db, query, params, oids, schema)), schema=schema)
+
+def to_parquet(db, directory, table, cids=None, start=None, end=None, columns=None):
+    '''
+    Write the rows of record_batches() to directory as Parquet files
+    partitioned by month (<directory>/month=YYYY-MM/part-N.parquet). The
+    months written are replaced. Returns the number of rows.
+    '''
+    query, params, oids, schema = selection(db, table, cids, start, end, columns)
+    rows = 0
+
+    def with_month(batches):
+        nonlocal rows
+        for batch in batches:
+            rows += batch.num_rows
+            month = pa.compute.strftime(batch.column('date'), format='%Y-%m')
+            yield batch.append_column('month', month)
+
+    pa.dataset.write_dataset(with_month(stream(db, query, params, oids, schema)), directory,
+                             schema=schema.append(pa.field('month', pa.string())),
+                             format='parquet', partitioning=['month'], partitioning_flavor='hive',
+                             existing_data_behavior='delete_matching')
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a table to Parquet files partitioned by month')
+    parser.add_argument('table')
+    parser.add_argument('--output', required=True, help='directory of the Parquet files')
+    parser.add_argument('--cids', type=int, nargs='+', help='companies, all of them by default')
+    parser.add_argument('--start', help='first date included')
+    parser.add_argument('--end', help='first date excluded')
+    parser.add_argument('--columns', nargs='+', help='columns, all of them by default')
+    parser.add_argument('--host', default='localhost', help='TimescaleDB host')
+    args = parser.parse_args()
+
+    import timescaledb_model as tsdb
+    db = tsdb.TimescaleStockMarketModel('bourse', 'ricou', args.host, 'monmdp')
+    begin = time.perf_counter()
+    rows = to_parquet(db, args.output, args.table, args.cids, args.start, args.end, args.columns)
+    print(f'{rows:,} rows exported to {args.output} in {time.perf_counter() - begin:.1f} s')
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Technical indicators computed for many companies at once.
+
+  A series is a row of a 2-D array, one company per row (see pack()), the
+  shorter series being padded with NaN at the end. The rolling windows use
+  cumulative sums, so their cost does not depend on the window, and the
+  exponential averages are computed by blocks of columns with a matrix
+  product, for all the rows together.
+
+  Used by the analyzer to fill the dayindicators table and by the dashboard
+  for the other frequencies and windows.
+
+  >>> close = np.array([[1., 2, 3, 4, 5], [2, 2, 2, 2, np.nan]])
+  >>> sma(close, 3)
+  array([[nan, nan,  2.,  3.,  4.],
+         [nan, nan,  2.,  2., nan]])
+  >>> ema(close, span=3)[0]
+  array([1.    , 1.5   , 2.25  , 3.125 , 4.0625])
+'''
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_WINDOW = 20
+# columns of compute() and of the dayindicators table
+COLUMNS = ['sma', 'upper', 'lower', 'ema', 'rsi', 'macd', 'macd_signal', 'atr', 'vwap']
+
+# ----------------------------- 2-D layout -------------------------------------
+
+def pack(values, groups):
+    '''Return the values as a 2-D array, one row per group in order of first
+    appearance, and the (rows, columns) index of each value in this array.'''
+    codes, uniques = pd.factorize(np.asarray(groups))
+    counts = np.bincount(codes, minlength=len(uniques))
+    starts = np.cumsum(counts) - counts
+    order = np.argsort(codes, kind='stable')
+    columns = np.empty(len(codes), dtype=int)
+    columns[order] = np.arange(len(codes)) - np.repeat(starts, counts)
+    array = np.full((len(uniques), counts.max(initial=0)), np.nan)
+    array[codes, columns] = values
+    return array, (codes, columns)
+
+def shift(values, periods=1):
+    '''The previous value of each column, NaN for the first ones'''
+    result = np.full(values.shape, np.nan)
+    result[:, periods:] = values[:, :-periods]
+    return result
+
+def ffill(values):
+    '''Missing values replaced by the last value before them in their row'''
+    index = np.where(np.isnan(values), 0, np.arange(values.shape[1]))
+    np.maximum.accumulate(index, axis=1, out=index)
+    return values[np.arange(values.shape[0])[:, None], index]
+
+def first(values):
+    '''The first finite value of each row, as a column (0 for empty rows)'''
+    finite = np.isfinite(values)
+    result = values[np.arange(values.shape[0]), finite.argmax(axis=1)]
+    return np.where(finite.any(axis=1), result, 0)[:, None]
+
+# ----------------------------- kernels ----------------------------------------
+
+def rolling_sum(values, window):
+    '''Sums over the last window columns, NaN if one of them is missing'''
+    finite = np.isfinite(values)
+    sums = np.cumsum(np.where(finite, values, 0), axis=1)
+    counts = np.cumsum(finite, axis=1)
+    sums[:, window:] = sums[:, window:] - sums[:, :-window]
+    counts[:, window:] = counts[:, window:] - counts[:, :-window]
+    return np.where(counts == window, sums, np.nan)
+
+def sma(values, window):
+    return rolling_sum(values, window) / window
+
+def rolling_std(values, window, ddof=1):
+    # centred on the first value of each row, the sums of squares lose their precision otherwise
+    values = values - first(values)
+    sums, squares = rolling_sum(values, window), rolling_sum(values * values, window)
+    return np.sqrt(np.maximum(squares - sums * sums / window, 0) / (window - ddof))
+
+def ema(values, span=None, alpha=None, block=64):
+    '''Exponential moving average, as pandas ewm(adjust=False). A missing value
+    is replaced by the last one in the average and is missing in the result.'''
+    alpha = 2 / (span + 1) if alpha is None else alpha
+    x = ffill(values)
+    x = np.where(np.isnan(x), first(values), x)
+    # y[j] = (1 - alpha)^(j+1) y[-1] + sum over k <= j of alpha (1 - alpha)^(j-k) x[k]
+    lags = np.subtract.outer(np.arange(block), np.arange(block))
+    weights = np.tril(alpha * (1 - alpha) ** np.maximum(lags, 0))
+    decay = (1 - alpha) ** np.arange(1, block + 1)
+    result = np.empty(x.shape)
+    previous = x[:, 0]
+    for start in range(0, x.shape[1], block):
+        size = min(block, x.shape[1] - start)
+        result[:, start:start + size] = (previous[:, None] * decay[:size]
+                                         + x[:, start:start + size] @ weights[:size, :size].T)
+        previous = result[:, start + size - 1]
+    result[np.isnan(values)] = np.nan
+    return result
+
+def wilder(values, window):
+    '''Wilder smoothing: exponential average of alpha 1/window, missing for the first window values'''
+    result = ema(values, alpha=1 / window)
+    result[:, :window] = np.nan
+    return result
+
+# ----------------------------- indicators -------------------------------------
+
+def bollinger(close, window=DEFAULT_WINDOW, k=2):
+    '''Moving average, upper and lower bands at k standard deviations'''
+    mean, std = sma(close, window), rolling_std(close, window)
+    return mean, mean + k * std, mean - k * std
+
+def rsi(close, window=14):
+    change = close - shift(close)
+    gain = wilder(np.where(change > 0, change, np.where(np.isnan(change), np.nan, 0)), window)
+    loss = wilder(np.where(change < 0, -change, np.where(np.isnan(change), np.nan, 0)), window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 100 - 100 / (1 + gain / loss)
+
+def macd(close, fast=12, slow=26, signal=9):
+    '''MACD line, signal line and histogram'''
+    line = ema(close, span=fast) - ema(close, span=slow)
+    signal_line = ema(line, span=signal)
+    return line, signal_line, line - signal_line
+
+def atr(high, low, close, window=14):
+    previous = shift(close)
+    true_range = np.fmax(high - low, np.fmax(np.abs(high - previous), np.abs(low - previous)))
+    true_range[np.isnan(high - low)] = np.nan
+    return wilder(true_range, window)
+
+def vwap(price, volume, window=DEFAULT_WINDOW):
+    '''Volume weighted average price over the last window bars'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return rolling_sum(price * volume, window) / rolling_sum(volume, window)
+
+def compute(bars, window=DEFAULT_WINDOW, names=COLUMNS, group='cid'):
+    '''
+    The indicators of bars (columns open, high, low, close, volume and group,
+    sorted by date within a group) as a dataframe with the index of bars.
+    Only the names asked for are computed.
+    '''
+    groups = bars[group] if group in bars else np.zeros(len(bars))
+    close, index = pack(bars['close'].to_numpy(dtype=float), groups)
+
+    def packed(column):
+        array = np.full(close.shape, np.nan)
+        if column in bars:
+            array[index] = bars[column].to_numpy(dtype=float)
+        return array
+
+    result = {}
+    if {'sma', 'upper', 'lower'} & set(names):
+        result['sma'], result['upper'], result['lower'] = bollinger(close, window)
+    if 'ema' in names:
+        result['ema'] = ema(close, span=window)
+    if 'rsi' in names:
+        result['rsi'] = rsi(close)
+    if {'macd', 'macd_signal'} & set(names):
+        result['macd'], result['macd_signal'], _ = macd(close)
+    if 'atr' in names or 'vwap' in names:
+        high, low = packed('high'), packed('low')
+        if 'atr' in names:
+            result['atr'] = atr(high, low, close)
+        if 'vwap' in names:
+            result['vwap'] = vwap((high + low + close) / 3, packed('volume'), window)
+    return pd.DataFrame({name: result[name][index] for name in names if name in result}, index=bars.index)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Counters and latency histograms of the ingestion.
+
+  Timers are context managers or decorators, counters are incremented with
+  inc(). Metrics may have labels, e.g. the table of dataframe_to_sql.
+  start_export() writes every interval seconds a JSON line with all the
+  metrics and a snapshot in the Prometheus text format (for the node exporter
+  textfile collector for instance).
+
+  Worker processes have their own metrics: collect() takes them out of the
+  worker and merge() adds them to the coordinator.
+
+  >>> with timer('doctest'):
+  ...     inc('doctest_rows', 10)
+  >>> snapshot()['counters']['doctest_rows']
+  10
+  >>> snapshot()['histograms']['doctest_seconds']['count']
+  1
+'''
+
+import functools
+import json
+import os
+import threading
+import time
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, float('inf'))
+
+_lock = threading.Lock()
+_counters = {}    # key -> value
+_histograms = {}  # key -> [bucket counts, sum, count]
+
+
+def key_of(name, labels=None):
+    '''Prometheus name of a metric: name{label="value",...}'''
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % item for item in sorted(labels.items())))
+
+def inc(name, value=1, labels=None):
+    key = key_of(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, labels=None):
+    key = key_of(name + '_seconds', labels)
+    with _lock:
+        histogram = _histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+class timer:
+    '''Time a block (with timer(name):) or a function (@timer(name))'''
+
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, self.labels)
+        return False
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(self.name, self.labels):
+                return function(*args, **kwargs)
+        return wrapper
+
+def snapshot():
+    with _lock:
+        return {
+            'time': time.time(),
+            'pid': os.getpid(),
+            'counters': dict(_counters),
+            'histograms': {key: {'buckets': list(h[0]), 'sum': h[1], 'count': h[2]}
+                           for key, h in _histograms.items()},
+        }
+
+def collect():
+    '''Return the metrics of this process and reset them'''
+    with _lock:
+        counters, histograms = dict(_counters), {k: [list(h[0]), h[1], h[2]] for k, h in _histograms.items()}
+        _counters.clear()
+        _histograms.clear()
+    return counters, histograms
+
+def reset():
+    '''Forget the metrics, e.g. the ones a forked worker got from its parent'''
+    collect()
+
+def merge(metrics):
+    '''Add metrics given by collect() in another process'''
+    counters, histograms = metrics
+    with _lock:
+        for key, value in counters.items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, (buckets, total, count) in histograms.items():
+            histogram = _histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+            histogram[1] += total
+            histogram[2] += count
+
+def prometheus_text(metrics):
+    lines = []
+    for key, value in sorted(metrics['counters'].items()):
+        lines.append(f'bourse_{key} {value}')
+    for key, histogram in sorted(metrics['histograms'].items()):
+        name, _, labels = key.partition('{')
+        labels = labels.rstrip('}')
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram['buckets']):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            all_labels = ','.join(filter(None, [labels, f'le="{le}"']))
+            lines.append(f'bourse_{name}_bucket{{{all_labels}}} {cumulative}')
+        suffix = '{%s}' % labels if labels else ''
+        lines.append(f'bourse_{name}_sum{suffix} {histogram["sum"]}')
+        lines.append(f'bourse_{name}_count{suffix} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+def export(jsonl_path, prometheus_path):
+    '''Append a JSON line to jsonl_path and rewrite the Prometheus snapshot'''
+    metrics = snapshot()
+    with open(jsonl_path, 'a') as file:
+        file.write(json.dumps(metrics) + '\n')
+    # write then rename so that a reader never sees a partial file
+    with open(prometheus_path + '.tmp', 'w') as file:
+        file.write(prometheus_text(metrics))
+    os.replace(prometheus_path + '.tmp', prometheus_path)
+
+def start_export(jsonl_path, prometheus_path, interval=60):
+    '''Export every interval seconds from a daemon thread. Returns a function
+    stopping the thread after a last export.'''
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            export(jsonl_path, prometheus_path)
+
+    thread = threading.Thread(target=run, name='metrics export', daemon=True)
+    thread.start()
+
+    def stop_export():
+        stop.set()
+        thread.join()
+        export(jsonl_path, prometheus_path)
+    return stop_export
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
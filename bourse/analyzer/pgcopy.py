@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Encode pandas dataframes in the binary format of the PostgreSQL COPY command,
+  and decode this format into numpy arrays (see decode()).
+
+  Each column is converted with numpy into a big endian array and all the
+  columns are packed into a structured array, one record per tuple, so no
+  value is ever formatted as text. Only fixed size types are supported (see
+  TYPES); rows with NULL values are grouped by NULL pattern because a NULL
+  field has no data and therefore changes the layout of the record.
+
+  cf https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+
+  >>> df = pd.DataFrame({'cid': [1, None], 'value': [1.5, 2.0]})
+  >>> b''.join(encode(df, [21, 700]))[19:]
+  b'\\x00\\x02\\x00\\x00\\x00\\x02\\x00\\x01\\x00\\x00\\x00\\x04?\\xc0\\x00\\x00\\x00\\x02\\xff\\xff\\xff\\xff\\x00\\x00\\x00\\x04@\\x00\\x00\\x00\\xff\\xff'
+  >>> columns, size = decode(b''.join(encode(df, [21, 700]))[19:], [21, 700])
+  >>> columns[0]
+  (array([1], dtype=int16), array([False]))
+  >>> size
+  16
+'''
+
+import struct
+import numpy as np
+import pandas as pd
+
+HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+TRAILER = struct.pack('>h', -1)
+
+# type oid -> numpy type of the binary representation
+TYPES = {
+    16: '?',        # bool
+    20: '>i8',      # int8
+    21: '>i2',      # int2
+    23: '>i4',      # int4
+    700: '>f4',     # float4
+    701: '>f8',     # float8
+    1114: '>i8',    # timestamp, microseconds since 2000-01-01
+    1184: '>i8',    # timestamptz, microseconds since 2000-01-01 UTC
+}
+TIMESTAMP, TIMESTAMPTZ = 1114, 1184
+
+POSTGRES_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+
+CHUNK_ROWS = 100000
+
+
+def supports(oids):
+    return all(oid in TYPES for oid in oids)
+
+def column_values(series, oid, timezone):
+    '''Return the column as a numpy array ready to be cast to TYPES[oid]'''
+    if oid in (TIMESTAMP, TIMESTAMPTZ):
+        dates = pd.to_datetime(series)
+        if oid == TIMESTAMPTZ:
+            # naive dates are in the time zone of the session, as with the text format
+            if dates.dt.tz is None:
+                dates = dates.dt.tz_localize(timezone, ambiguous=False, nonexistent='shift_forward')
+            dates = dates.dt.tz_convert('UTC').dt.tz_localize(None)
+        elif dates.dt.tz is not None:
+            dates = dates.dt.tz_convert(timezone).dt.tz_localize(None)
+        dates = dates.fillna(pd.Timestamp(POSTGRES_EPOCH))
+        return (dates.to_numpy('datetime64[us]') - POSTGRES_EPOCH).astype('i8')
+    if series.hasnans:
+        series = series.fillna(0)
+    return series.to_numpy()
+
+def encode_chunk(df, oids, timezone='UTC'):
+    '''Return the tuples of df in the binary COPY format (no header nor trailer)'''
+    nulls = np.column_stack([df[c].isna().to_numpy() for c in df.columns])
+    values = [column_values(df[c], oid, timezone) for c, oid in zip(df.columns, oids)]
+    if nulls.any():
+        patterns, inverse = np.unique(nulls, axis=0, return_inverse=True)
+        groups = [(pattern, np.flatnonzero(inverse.reshape(-1) == i)) for i, pattern in enumerate(patterns)]
+    else:
+        groups = [(nulls[0], slice(None))]
+
+    parts = []
+    for pattern, rows in groups:
+        fields = [('count', '>i2')]
+        for i, oid in enumerate(oids):
+            fields.append((f'l{i}', '>i4'))
+            if not pattern[i]:
+                fields.append((f'v{i}', TYPES[oid]))
+        records = np.empty(len(values[0][rows]), dtype=fields)
+        records['count'] = len(oids)
+        for i, oid in enumerate(oids):
+            if pattern[i]:
+                records[f'l{i}'] = -1
+            else:
+                records[f'l{i}'] = np.dtype(TYPES[oid]).itemsize
+                records[f'v{i}'] = values[i][rows]
+        parts.append(records.tobytes())
+    return b''.join(parts)
+
+def encode(df, oids, timezone='UTC', chunk_rows=CHUNK_ROWS):
+    '''Yield the whole COPY stream of df, chunk_rows tuples at a time'''
+    yield HEADER
+    for start in range(0, len(df), chunk_rows):
+        yield encode_chunk(df.iloc[start:start + chunk_rows], oids, timezone)
+    yield TRAILER
+
+
+def record_dtype(oids):
+    '''Structured type of a tuple without NULL field'''
+    fields = [('count', '>i2')]
+    for i, oid in enumerate(oids):
+        fields += [(f'l{i}', '>i4'), (f'v{i}', TYPES[oid])]
+    return np.dtype(fields)
+
+def native(oid):
+    return np.dtype(TYPES[oid]).newbyteorder('=')
+
+def decode(data, oids):
+    '''
+    Decode the tuples at the start of data (COPY binary format, without the
+    header) into a (values, nulls) pair of arrays per column. Returns also the
+    number of bytes decoded, None and 0 when data starts with the trailer or
+    with a partial tuple. The tuples are decoded together until the first
+    one with a NULL field, which is decoded alone.
+    '''
+    dtype = record_dtype(oids)
+    records = np.frombuffer(data, dtype, len(data) // dtype.itemsize)
+    valid = records['count'] == len(oids)
+    for i, oid in enumerate(oids):
+        valid &= records[f'l{i}'] == np.dtype(TYPES[oid]).itemsize
+    rows = len(records) if valid.all() else int(valid.argmin())
+    if rows == 0:
+        return decode_tuple(data, oids)
+    records = records[:rows]
+    return ([(records[f'v{i}'].astype(native(oid)), np.zeros(rows, dtype=bool)) for i, oid in enumerate(oids)],
+            rows * dtype.itemsize)
+
+def decode_tuple(data, oids):
+    '''decode() of the first tuple of data only, it may have NULL fields'''
+    if len(data) < 2 or struct.unpack_from('>h', data)[0] != len(oids):
+        return None, 0
+    position, columns = 2, []
+    for oid in oids:
+        if len(data) < position + 4:
+            return None, 0
+        size = struct.unpack_from('>i', data, position)[0]
+        position += 4
+        if size < 0:
+            columns.append((np.zeros(1, dtype=native(oid)), np.ones(1, dtype=bool)))
+            continue
+        if len(data) < position + size:
+            return None, 0
+        columns.append((np.frombuffer(data, TYPES[oid], 1, position).astype(native(oid)), np.zeros(1, dtype=bool)))
+        position += size
+    return columns, position
+
+
+class CopyReader:
+    '''File-like object giving the chunks of a generator to cursor.copy_expert'''
+
+    def __init__(self, chunks):
+        self.__chunks = iter(chunks)
+        self.__chunk = b''
+        self.__position = 0
+
+    def read(self, size=-1):
+        while self.__position >= len(self.__chunk):
+            self.__chunk = next(self.__chunks, None)
+            self.__position = 0
+            if self.__chunk is None:
+                self.__chunk = b''
+                return b''
+        end = len(self.__chunk) if size < 0 else self.__position + size
+        data = self.__chunk[self.__position:end]
+        self.__position += len(data)
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
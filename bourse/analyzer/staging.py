@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Parquet staging cache of the cleaned boursorama files.
+
+  Each cleaned file is written once to
+    <directory>/market=<market>/month=<YYYY-MM>/<file name>.<mtime>.parquet
+  keyed by the name and the modification time of the source, so a file
+  changed on disk is decoded again. Later runs (after a crash, a schema change
+  or for a backfill) read it memory-mapped with only the ingested columns
+  instead of paying bz2 and pickle again. The layout is a hive partitioned
+  dataset, see dataset().
+
+  pyarrow is optional: without it the staging is disabled.
+'''
+
+import glob
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# columns used by the ingestion, the date, file name and market come from the path
+COLUMNS = ['symbol', 'last', 'volume', 'name', 'suffix']
+
+
+def available():
+    return pa is not None
+
+def staged_path(directory, path, market, date):
+    mtime = os.stat(path).st_mtime_ns
+    return os.path.join(directory, f'market={market}', f'month={date:%Y-%m}',
+                        f'{os.path.basename(path)}.{mtime}.parquet')
+
+def load(directory, path, market, date, columns=COLUMNS):
+    '''Return the staged dataframe of path, None if it is not staged (or
+    staged without some of the columns)'''
+    staged = staged_path(directory, path, market, date)
+    if not os.path.exists(staged) or not set(columns) <= set(pq.read_schema(staged).names):
+        return None
+    return pq.read_table(staged, columns=columns, memory_map=True).to_pandas()
+
+def store(directory, path, market, date, df):
+    staged = staged_path(directory, path, market, date)
+    os.makedirs(os.path.dirname(staged), exist_ok=True)
+    # older versions of the same source
+    for old in glob.glob(glob.escape(staged.rsplit('.', 2)[0]) + '.*.parquet'):
+        os.remove(old)
+    table = pa.Table.from_pandas(df[COLUMNS], preserve_index=False)
+    # write then rename so that a crash or another worker never sees a partial file
+    pq.write_table(table, staged + '.tmp')
+    os.replace(staged + '.tmp', staged)
+
+def dataset(directory):
+    '''The staged files as one pyarrow dataset, partitioned by market and month'''
+    return pa.dataset.dataset(directory, format='parquet', partitioning='hive')
@@ -4,22 +4,78 @@
 # pipenv install sqlalchemy-timescaledb
 
 import datetime
+import os
+import threading
+import warnings
+import weakref
+from contextlib import contextmanager
 from io import StringIO
 import psycopg2
+import psycopg2.pool
 import pandas as pd
 import sqlalchemy
 
+import metrics
 import mylogging
+import pgcopy
 
 class TimescaleStockMarketModel:
     """ Bourse model with TimeScaleDB persistence."""
 
-    def __init__(self, database, user=None, host=None, password=None, port=None):
+    # continuous aggregates: name, bucket, source and aggregates of the source columns
+    AGGREGATES = [
+        ('hourstocks', '1 hour', 'stocks',
+         'first(value, date), last(value, date), max(value), min(value), sum(volume)'),
+        ('daystocks', '1 day', 'stocks',
+         'first(value, date), last(value, date), max(value), min(value), sum(volume)'),
+        ('weekstocks', '1 week', 'daystocks',
+         'first(open, date), last(close, date), max(high), min(low), sum(volume)'),
+    ]
+
+    # chunk interval of the hypertables, a month of ticks is a few million rows
+    CHUNK_INTERVALS = {'stocks': '30 days', 'daystocks': '365 days'}
+
+    # seconds a call waits for a free connection when the pool_size connections are taken
+    POOL_TIMEOUT = 600
+
+    # server side prepared statements of the frequent queries: name -> (types of the parameters, query)
+    PREPARED = {
+        'is_file_done': ('varchar', 'SELECT EXISTS (SELECT 1 FROM file_done WHERE name = $1)'),
+        'company_by_name': ('varchar', 'SELECT id FROM companies WHERE name = $1'),
+        'company_like': ('varchar', 'SELECT id FROM companies WHERE name LIKE $1'),
+        'company_ilike': ('varchar', 'SELECT id FROM companies WHERE LOWER(name) LIKE LOWER($1)'),
+        'register_companies': ('varchar[], smallint[], varchar[]',
+                               '''INSERT INTO companies (name, mid, symbol)
+                                 SELECT * FROM unnest($1, $2, $3)
+                                 ON CONFLICT (symbol, mid) DO UPDATE SET symbol = EXCLUDED.symbol
+                                 RETURNING symbol, mid, id'''),
+    }
+
+    def __init__(self, database, user=None, host=None, password=None, port=None,
+                 continuous_aggregates=False, chunk_intervals=None, compress=False,
+                 compress_after=None, pool_size=4):
         """Create a TimescaleStockMarketModel
 
         database -- The name of the persistence database.
         user     -- Username to connect with to the database. Same as the
                     database name by default.
+        continuous_aggregates -- daystocks (and hourstocks, weekstocks) are
+                    continuous aggregates of stocks maintained by TimescaleDB
+                    instead of a table written by the analyzer. To switch an
+                    existing database, drop the daystocks table first.
+        chunk_intervals -- chunk interval of the hypertables by table name,
+                    see CHUNK_INTERVALS. On an existing database only the new
+                    chunks get it.
+        compress -- stocks and daystocks are compressed by cid and date, the
+                    chunks are compressed by compress_before.
+        compress_after -- if given (e.g. '30 days'), implies compress and a
+                    policy compresses the chunks older than this interval,
+                    counted from now(). Keep it longer than the dates being
+                    ingested, or the policy compresses the chunks still written.
+        pool_size -- maximum number of connections opened by the model. A
+                    thread gets one for each call, or for a whole transaction(),
+                    and waits (POOL_TIMEOUT at most) when they are all taken.
+                    A forked process opens its own connections.
 
         """
 
@@ -30,21 +86,129 @@ class TimescaleStockMarketModel:
         self.__host = host or 'localhost'
         self.__port = port or 5432
         self.__password = password or ''
-        self.__squash = False
-        self.__connection = psycopg2.connect(database=self.__database,
-                                             user=self.__user,
-                                             host=self.__host,
-                                             password=self.__password)
+        self.__pool_size = pool_size
+        self.__pool = None
+        self.__available = None  # semaphore of the free connections of the pool
+        self.__pool_pid = None
+        self.__inherited_pools = []  # pools of the parent process, never used nor closed
+        self.__local = threading.local()  # connection of the transaction of each thread
+        self.__prepared = weakref.WeakKeyDictionary()  # connection -> names of its prepared statements
+        self.__lock = threading.Lock()
+        self.continuous_aggregates = continuous_aggregates
+        self.chunk_intervals = dict(self.CHUNK_INTERVALS, **(chunk_intervals or {}))
+        self.compress = compress or compress_after is not None
+        self.compress_after = compress_after
         self.__engine = sqlalchemy.create_engine(f'timescaledb://{self.__user}:{self.__password}@{self.__host}:{self.__port}/{self.__database}')
         self.__nf_cid = {}  # cid from netfonds symbol
         self.__boursorama_cid = {}  # cid from netfonds symbol
         self.__market_id = {}  # id of markets from aliases
+        self.__column_types = {}  # (table, columns) -> type oids, for binary COPY
+        self.__timezone = None  # time zone of the session, for binary COPY
 
         self.logger.info("Setup database generates an error if it exists already, it's ok")
-        self._setup_database()
+        with self.connection() as connection:
+            self._setup_database(connection)
+            self._upgrade_database(connection)
+        if self.continuous_aggregates:
+            # Continuous aggregates cannot be created inside a transaction
+            with self.autocommit() as connection:
+                self._setup_aggregates(connection)
+        with self.connection() as connection:
+            self._setup_chunks(connection)
+
+    # ------------------------------ connections -----------------------------------
+
+    def _get_pool(self):
+        with self.__lock:
+            if self.__pool_pid != os.getpid():
+                # after a fork the connections of the parent are its own: closing them
+                # here would close them for the parent too
+                if self.__pool is not None:
+                    self.__inherited_pools.append(self.__pool)
+                self.__pool = psycopg2.pool.ThreadedConnectionPool(
+                    1, self.__pool_size, database=self.__database, user=self.__user,
+                    host=self.__host, port=self.__port, password=self.__password)
+                self.__available = threading.BoundedSemaphore(self.__pool_size)
+                self.__pool_pid = os.getpid()
+                self.__local = threading.local()
+            return self.__pool
+
+    @contextmanager
+    def _checkout(self):
+        '''A connection of the pool, waiting for one if they are all taken
+        (ThreadedConnectionPool.getconn raises PoolError instead of waiting)'''
+        pool = self._get_pool()
+        available = self.__available
+        if not available.acquire(timeout=self.POOL_TIMEOUT):
+            raise psycopg2.pool.PoolError(f'No free connection after {self.POOL_TIMEOUT} s '
+                                          f'({self.__pool_size} in use)')
+        try:
+            connection = pool.getconn()
+            try:
+                yield connection
+            finally:
+                pool.putconn(connection)
+        finally:
+            available.release()
+
+    def in_transaction(self):
+        return getattr(self.__local, 'connection', None) is not None and self.__pool_pid == os.getpid()
+
+    @contextmanager
+    def connection(self):
+        '''
+        A connection for the block: the one of the transaction() of the thread
+        if there is one, else a connection of the pool whose work is committed
+        at the end of the block (or rolled back if an exception is raised).
+        '''
+        if self.in_transaction():
+            yield self.__local.connection
+            return
+        with self._checkout() as connection:
+            try:
+                yield connection
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+
+    @contextmanager
+    def autocommit(self):
+        '''A connection of the pool in autocommit mode, for the commands which
+        cannot run in a transaction'''
+        with self._checkout() as connection:
+            connection.autocommit = True
+            try:
+                yield connection
+            finally:
+                connection.autocommit = False
+
+    def prepared(self, name, args):
+        '''
+        Execute the prepared statement name of PREPARED with args and return
+        its rows. The statement is prepared once by connection.
+        '''
+        self.logger.debug('SQL: EXECUTE %s %r' % (name, args))
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            types, query = self.PREPARED[name]
+            prepared = self.__prepared.setdefault(connection, set())
+            if name not in prepared:
+                cursor.execute(f'PREPARE {name} ({types}) AS {query};')
+                prepared.add(name)
+            placeholders = ', '.join(f'%s::{t}' for t in types.split(', '))
+            cursor.execute(f'EXECUTE {name} ({placeholders});', args)
+            return cursor.fetchall()
+
+    def close(self):
+        if self.__pool is not None and self.__pool_pid == os.getpid():
+            self.__pool.closeall()
+        self.__pool = None
+        self.__pool_pid = None
 
+    # ------------------------------ setup -----------------------------------------
 
-    def _setup_database(self):
+    def _setup_database(self, connection):
         try:
             # Create the tables if they do not exist.
             #
@@ -52,7 +216,7 @@ class TimescaleStockMarketModel:
             #   drop schema public cascade;
             #   create schema public;
             #
-            cursor = self.__connection.cursor()
+            cursor = connection.cursor()
             # markets (see end for list of makets)
             cursor.execute('''CREATE SEQUENCE market_id_seq START 1;''')
             cursor.execute(
@@ -85,20 +249,23 @@ class TimescaleStockMarketModel:
                   value FLOAT4,
                   volume INT
                 );''')
-            cursor.execute('''SELECT create_hypertable('stocks', by_range('date'));''')
+            cursor.execute('''SELECT create_hypertable('stocks', by_range('date', %s::interval));''',
+                           (self.chunk_intervals['stocks'],))
             cursor.execute('''CREATE INDEX idx_cid_stocks ON stocks (cid, date DESC);''')
-            cursor.execute(
-                '''CREATE TABLE daystocks (
-                  date TIMESTAMPTZ,
-                  cid SMALLINT,
-                  open FLOAT4,
-                  close FLOAT4,
-                  high FLOAT4,
-                  low FLOAT4,
-                  volume INT
-                );''')
-            cursor.execute('''SELECT create_hypertable('daystocks', by_range('date'));''')
-            cursor.execute('''CREATE INDEX idx_cid_daystocks ON daystocks (cid, date DESC);''')
+            if not self.continuous_aggregates:
+                cursor.execute(
+                    '''CREATE TABLE daystocks (
+                      date TIMESTAMPTZ,
+                      cid SMALLINT,
+                      open FLOAT4,
+                      close FLOAT4,
+                      high FLOAT4,
+                      low FLOAT4,
+                      volume INT
+                    );''')
+                cursor.execute('''SELECT create_hypertable('daystocks', by_range('date', %s::interval));''',
+                               (self.chunk_intervals['daystocks'],))
+                cursor.execute('''CREATE UNIQUE INDEX idx_cid_date_daystocks ON daystocks (cid, date DESC);''')
             cursor.execute(
                 '''CREATE TABLE file_done (
                   name VARCHAR PRIMARY KEY
@@ -121,26 +288,153 @@ class TimescaleStockMarketModel:
             cursor.execute("INSERT INTO markets (id, name, alias) VALUES (10,'Bruxelle','bruxelle');")
         except Exception as e:
             self.logger.exception('SQL error: %s' % e)
-        self.__connection.commit()
+        connection.commit()
+
+    def _upgrade_database(self, connection):
+        # Tables and indexes added after the first version, also created in existing databases
+        upgrades = [
+            # one row per batch committed by the analyzer, in the same transaction as the data
+            '''CREATE TABLE IF NOT EXISTS ingest_journal (
+              id SERIAL PRIMARY KEY,
+              committed_at TIMESTAMPTZ DEFAULT now(),
+              files INT,
+              rows INT,
+              first_file VARCHAR,
+              last_file VARCHAR
+            );''',
+            # the key of the upsert in register_companies
+            '''CREATE UNIQUE INDEX IF NOT EXISTS idx_symbol_mid_companies ON companies (symbol, mid);''',
+            # daily technical indicators written by the analyzer, see indicators.py
+            '''CREATE TABLE IF NOT EXISTS dayindicators (
+              date TIMESTAMPTZ,
+              cid SMALLINT,
+              sma FLOAT4,
+              upper FLOAT4,
+              lower FLOAT4,
+              ema FLOAT4,
+              rsi FLOAT4,
+              macd FLOAT4,
+              macd_signal FLOAT4,
+              atr FLOAT4,
+              vwap FLOAT4
+            );''',
+            '''SELECT create_hypertable('dayindicators', by_range('date', INTERVAL '365 days'), if_not_exists => TRUE);''',
+            '''CREATE INDEX IF NOT EXISTS idx_cid_dayindicators ON dayindicators (cid, date DESC);''',
+        ]
+        cursor = connection.cursor()
+        for upgrade in upgrades:
+            try:
+                cursor.execute(upgrade)
+                connection.commit()
+            except Exception as e:
+                self.logger.exception('SQL error: %s' % e)
+                connection.rollback()
+        if not self.continuous_aggregates:
+            self._upgrade_daystocks_key(connection)
+
+    def _upgrade_daystocks_key(self, connection):
+        '''
+        Create the unique index (cid, date) of merge_daystocks in a database
+        written before it. Its daystocks may have several bars per company and
+        day (the bars of each run, dated at their first tick): they are merged
+        first into one bar at midnight. Raises if it fails, since no batch could
+        be written without the index.
+        '''
+        cursor = connection.cursor()
+        cursor.execute("SELECT to_regclass('idx_cid_date_daystocks') IS NOT NULL;")
+        if cursor.fetchone()[0]:
+            return
+        self.logger.info('Merging the bars of daystocks by company and day')
+        try:
+            # TRUNCATE also drops the compressed chunks, the new ones are compressed by compress_before
+            cursor.execute('''CREATE TEMP TABLE daystocks_days ON COMMIT DROP AS
+                                SELECT date_trunc('day', date) AS date, cid, first(open, date) AS open,
+                                       last(close, date) AS close, max(high) AS high, min(low) AS low,
+                                       LEAST(sum(volume::BIGINT), 2147483647)::INT AS volume
+                                FROM daystocks GROUP BY 1, 2;
+                              TRUNCATE daystocks;
+                              CREATE UNIQUE INDEX idx_cid_date_daystocks ON daystocks (cid, date DESC);
+                              DROP INDEX IF EXISTS idx_cid_daystocks;
+                              INSERT INTO daystocks (date, cid, open, close, high, low, volume)
+                                SELECT date, cid, open, close, high, low, volume FROM daystocks_days;''')
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            raise RuntimeError(f'Cannot create the unique index of daystocks (cid, date): {e}') from e
+
+    def _setup_aggregates(self, connection):
+        try:
+            cursor = connection.cursor()
+            for name, bucket, source, aggregates in self.AGGREGATES:
+                cursor.execute(
+                    f'''CREATE MATERIALIZED VIEW IF NOT EXISTS {name} (date, cid, open, close, high, low, volume)
+                      WITH (timescaledb.continuous) AS
+                      SELECT time_bucket('{bucket}', date), cid, {aggregates}
+                      FROM {source}
+                      GROUP BY time_bucket('{bucket}', date), cid
+                      WITH NO DATA;''')
+                cursor.execute(f'''CREATE INDEX IF NOT EXISTS idx_cid_{name} ON {name} (cid, date DESC);''')
+                # the analyzer refreshes what it writes, the policy catches up anything else
+                cursor.execute(
+                    f'''SELECT add_continuous_aggregate_policy('{name}',
+                      start_offset => NULL, end_offset => NULL,
+                      schedule_interval => INTERVAL '{bucket}', if_not_exists => true);''')
+        except Exception as e:
+            self.logger.exception('SQL error: %s' % e)
+
+    def hypertables(self):
+        # the continuous aggregates are not compressed, their refresh policy covers all the data
+        return ['stocks'] if self.continuous_aggregates else ['stocks', 'daystocks']
+
+    def _setup_chunks(self, connection):
+        # Chunk intervals and compression, also applied to existing databases
+        cursor = connection.cursor()
+        for table in self.hypertables():
+            settings = [('SELECT set_chunk_time_interval(%s, %s::interval);', (table, self.chunk_intervals[table]))]
+            if self.compress:
+                # one compressed row per cid and 1000 dates: range scans of a company read few pages
+                settings.append((f'''ALTER TABLE {table} SET (timescaledb.compress,
+                                      timescaledb.compress_segmentby = 'cid',
+                                      timescaledb.compress_orderby = 'date DESC');''', None))
+            if self.compress_after is not None:
+                settings.append(('SELECT add_compression_policy(%s, compress_after => %s::interval, if_not_exists => true);',
+                                 (table, self.compress_after)))
+            elif self.compress:
+                # a policy left by an earlier run would compress the chunks being backfilled
+                settings.append(('SELECT remove_compression_policy(%s, if_exists => true);', (table,)))
+            for query, args in settings:
+                try:
+                    cursor.execute(query, args)
+                    connection.commit()
+                except Exception as e:
+                    self.logger.exception('SQL error: %s' % e)
+                    connection.rollback()
 
     # ------------------------------ public methods --------------------------------
 
     def execute(self, query, args=None, cursor=None, commit=False):
-        """Send a Postgres SQL command. No return"""
+        """Send a Postgres SQL command. No return
+
+        Outside a transaction() the command is committed, commit is kept for compatibility.
+        """
         if args is None:
             pretty = query
         else:
             pretty = '%s %% %r' % (query, args)
         self.logger.debug('SQL: QUERY: %s' % pretty)
-        if cursor is None:
-            cursor = self.__connection.cursor()
-        cursor.execute(query, args)
-        if commit:
-            self.commit()
-        try:
-            return cursor.fetchall()
-        except:
-            pass
+        if cursor is not None:
+            cursor.execute(query, args)
+            try:
+                return cursor.fetchall()
+            except:
+                return None
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(query, args)
+            try:
+                return cursor.fetchall()
+            except:
+                pass
 
     def df_write(self, df, table, args=None, commit=False,
                  if_exists='append', index=True, index_label=None,
@@ -161,6 +455,7 @@ class TimescaleStockMarketModel:
 
     # general query methods
 
+    @metrics.timer('raw_query')
     def raw_query(self, query, args=None, cursor=None):
         """Return a tuple from a Postgres SQL query"""
         if args is None:
@@ -168,32 +463,72 @@ class TimescaleStockMarketModel:
         else:
             pretty = '%s %% %r' % (query, args)
         self.logger.debug('SQL: QUERY: %s' % pretty)
-        if cursor is None:
-            cursor = self.__connection.cursor()
-        cursor.execute(query, args)
-        return cursor.fetchall()
+        if cursor is not None:
+            cursor.execute(query, args)
+            return cursor.fetchall()
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(query, args)
+            return cursor.fetchall()
 
-    def df_query(self, query, args=None, index_col=None, coerce_float=True, params=None, 
+    def df_query(self, query, args=None, index_col=None, coerce_float=True, params=None,
                  parse_dates=None, columns=None, chunksize=1000, dtype=None):
-        '''Returns a Pandas dataframe from a Postgres SQL query
+        '''Returns a Pandas dataframe from a Postgres SQL query, or an iterator of
+        dataframes if chunksize is not None
 
-        :param query:
-        :param args: arguments for the query
+        :param query: query with %s (or %(name)s) placeholders
+        :param args: arguments for the query, sent with it (same as params)
         :param other args: see https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.read_sql.html
         :return: a dataframe
         '''
-        if args is not None:
-            query = query % args
-        self.logger.debug('df_query: %s' % query)
-        return pd.read_sql(query, self.__engine, index_col=index_col, coerce_float=coerce_float, 
-                           params=params, parse_dates=parse_dates, columns=columns, 
-                           chunksize=chunksize, dtype=dtype)
+        params = args if args is not None else params
+        self.logger.debug('df_query: %s %% %r' % (query, params))
+        options = dict(index_col=index_col, coerce_float=coerce_float, params=params,
+                       parse_dates=parse_dates, columns=columns, dtype=dtype)
+        if chunksize is None:
+            with self.connection() as connection, metrics.timer('df_query'):
+                return self._read_sql(query, connection, **options)
+        return self._read_sql_chunks(query, chunksize, **options)
+
+    def _read_sql_chunks(self, query, chunksize, **options):
+        # the connection is kept until the last chunk is read (or the iterator is dropped)
+        with self.connection() as connection:
+            with metrics.timer('df_query'):
+                chunks = self._read_sql(query, connection, chunksize=chunksize, **options)
+            yield from chunks
+
+    @staticmethod
+    def _read_sql(query, connection, **options):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)  # pandas prefers SQLAlchemy connections
+            return pd.read_sql(query, connection, **options)
 
     # system methods
 
     def commit(self):
-        if not self.__squash:
-            self.__connection.commit()
+        '''Nothing to do: outside a transaction() each call is committed at its end'''
+        pass
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Commit all the writes of the block at once, or none of them if an
+        exception is raised. Inside the block the calls of the thread use the
+        same connection and dataframe_to_sql raises its errors. A nested
+        transaction() is part of the outer one.
+
+        >>> with db.transaction():    # doctest: +SKIP
+        ...     db.dataframe_to_sql(df, 'stocks')
+        '''
+        if self.in_transaction():
+            yield
+            return
+        with self.connection() as connection:
+            self.__local.connection = connection
+            try:
+                yield
+            finally:
+                self.__local.connection = None
 
     # write here your methods which SQL requests
 
@@ -215,19 +550,17 @@ class TimescaleStockMarketModel:
         0
         '''
         if getmax > 1:
-            res = self.raw_query('SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)',
-                                 ('%' + name + '%',))
+            res = self.prepared('company_ilike', ('%' + name + '%',))
         else:
-            res = self.raw_query('SELECT (id) FROM companies WHERE name = %s', (name,))
+            res = self.prepared('company_by_name', (name,))
             if len(res) == 0 and not strict:
-                res = self.raw_query('SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)', (name,))
+                res = self.prepared('company_ilike', (name,))
                 if len(res) == 0:
-                    res = self.raw_query('SELECT (id) FROM companies WHERE name LIKE %s', (name + '%',))
+                    res = self.prepared('company_like', (name + '%',))
                     if len(res) == 0:
-                        res = self.raw_query('SELECT (id) FROM companies WHERE name LIKE %s', ('%' + name + '%',))
+                        res = self.prepared('company_like', ('%' + name + '%',))
                         if len(res) == 0:
-                            res = self.raw_query('SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)',
-                                                 ('%' + name + '%',))
+                            res = self.prepared('company_ilike', ('%' + name + '%',))
         if len(res) == 1:
             return res[0][0]
         elif len(res) > 1 and len(res) < getmax:
@@ -235,43 +568,168 @@ class TimescaleStockMarketModel:
         else:
             return 0
 
+    def register_companies(self, names, mids, symbols):
+        '''
+        Insert the companies which are not known yet, in one statement. The ids
+        come from company_id_seq. Returns the (symbol, mid, id) of all the
+        given companies, the new ones and the ones already there.
+        '''
+        res = self.prepared('register_companies',
+                            ([None if pd.isna(name) else str(name) for name in names],
+                             [int(mid) for mid in mids], [str(symbol) for symbol in symbols]))
+        return pd.DataFrame(res, columns=['symbol', 'mid', 'id'])
+
+    def refresh_aggregates(self, start, end):
+        '''
+        Refresh the continuous aggregates for the data written between start
+        and end (the buckets containing them are refreshed).
+        '''
+        if not self.continuous_aggregates:
+            return
+        with self.autocommit() as connection:
+            cursor = connection.cursor()
+            for name, bucket, _, _ in self.AGGREGATES:
+                self.logger.debug('refresh %s from %s to %s' % (name, start, end))
+                cursor.execute(f"CALL refresh_continuous_aggregate('{name}', %s::timestamptz - INTERVAL '{bucket}', "
+                               f"%s::timestamptz + INTERVAL '{bucket}');", (start, end))
+
+    def compress_before(self, date):
+        '''
+        Compress the chunks which end before date, e.g. the months which the
+        analyzer has finished. Does nothing if compression is not set up.
+        '''
+        if not self.compress:
+            return
+        for table in self.hypertables():
+            with self.connection() as connection, metrics.timer('compress_chunks', {'table': table}):
+                connection.cursor().execute(f'''SELECT compress_chunk(c, if_not_compressed => true)
+                                                FROM show_chunks('{table}', older_than => %s::timestamptz) c;''', (date,))
+
+    def last_journal_entry(self):
+        '''
+        Return the last batch committed by the analyzer as a dict, None if none
+        '''
+        res = self.raw_query('SELECT id, committed_at, files, rows, first_file, last_file '
+                             'FROM ingest_journal ORDER BY id DESC LIMIT 1;')
+        if len(res) == 0:
+            return None
+        return dict(zip(['id', 'committed_at', 'files', 'rows', 'first_file', 'last_file'], res[0]))
+
     def is_file_done(self, name):
         '''
         Check if a file has already been included in the DB
         '''
-        return self.raw_query("SELECT EXISTS ( SELECT 1 FROM file_done WHERE name = '%s' );" % name)[0][0]
-    
-    def dataframe_to_sql(self, df, table_name, columns=None):
+        return self.prepared('is_file_done', (name,))[0][0]
 
+    def get_files_done(self, itersize=10000):
+        '''
+        Return the set of the files already included in the DB, in one query.
+        A server side cursor streams the names so the whole result is never
+        held twice in memory.
+        '''
+        self.logger.debug('get_files_done')
+        with self.connection() as connection, connection.cursor(name='files_done') as cursor:
+            cursor.itersize = itersize
+            cursor.execute("SELECT name FROM file_done;")
+            files_done = {row[0] for row in cursor}
+        return files_done
+    
+    def column_types(self, table_name, columns=None):
+        '''
+        Return the type oids of the columns of a table
+        '''
+        key = (table_name, tuple(columns) if columns is not None else None)
+        if key not in self.__column_types:
+            cols = ', '.join(columns) if columns is not None else '*'
+            with self.connection() as connection, connection.cursor() as cursor:
+                cursor.execute(f'SELECT {cols} FROM {table_name} LIMIT 0;')
+                self.__column_types[key] = [d.type_code for d in cursor.description]
+        return self.__column_types[key]
+
+    def timezone(self):
+        if self.__timezone is None:
+            self.__timezone = self.raw_query('SHOW TimeZone;')[0][0]
+        return self.__timezone
+
+    def _copy_csv(self, cursor, df, table_name, columns):
         # Create a StringIO object to use as a file-like object for the COPY FROM command
         buffer = StringIO()
         # Convert DataFrame to CSV format without the header and index
         df.to_csv(buffer, sep='\t', index=False, header=False, na_rep='\\N')
         # Move to the beginning of the StringIO object
         buffer.seek(0)
-        # print(buffer.getvalue())
+        # Use the copy_from method to load the data into the table
+        cursor.copy_from(buffer, table_name, sep='\t', null='\\N', columns=columns)
+
+    def _copy_binary(self, cursor, df, table_name, columns, oids):
+        cols = ' (%s)' % ', '.join(columns) if columns is not None else ''
+        reader = pgcopy.CopyReader(pgcopy.encode(df, oids, self.timezone()))
+        cursor.copy_expert(f'COPY {table_name}{cols} FROM STDIN (FORMAT binary)', reader, size=1 << 20)
+
+    def merge_daystocks(self, df, binary=False):
+        '''
+        Add daily bars (date at midnight, cid, open, close, high, low, volume)
+        to daystocks. A bar of a day already there, e.g. a day cut by the end
+        of a run, is merged with it: the open is kept, the close replaced by
+        the new one, the high and low extended and the volumes added.
+
+        The bars are copied to a temporary table of the connection, then
+        inserted with ON CONFLICT (cid, date) in one statement.
+        '''
+        columns = ['date', 'cid', 'open', 'close', 'high', 'low', 'volume']
+        if binary:
+            oids = self.column_types('daystocks', columns)
+        with self.connection() as connection, connection.cursor() as cursor, \
+                metrics.timer('dataframe_to_sql', {'table': 'daystocks'}):
+            cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS daystocks_merge (LIKE daystocks) ON COMMIT DELETE ROWS;
+                              TRUNCATE daystocks_merge;''')
+            if binary:
+                self._copy_binary(cursor, df, 'daystocks_merge', columns, oids)
+            else:
+                self._copy_csv(cursor, df, 'daystocks_merge', columns)
+            cursor.execute('''INSERT INTO daystocks (date, cid, open, close, high, low, volume)
+                              SELECT date, cid, open, close, high, low, volume FROM daystocks_merge
+                              ON CONFLICT (cid, date) DO UPDATE SET
+                                close = EXCLUDED.close,
+                                high = GREATEST(daystocks.high, EXCLUDED.high),
+                                low = LEAST(daystocks.low, EXCLUDED.low),
+                                volume = LEAST(daystocks.volume::BIGINT + EXCLUDED.volume, 2147483647);''')
+        metrics.inc('rows_written_total', len(df), {'table': 'daystocks'})
+
+    def dataframe_to_sql(self, df, table_name, columns=None, binary=False):
+        '''
+        Append a dataframe to a table with COPY
+
+        :param columns: columns of the table, in the order of the dataframe
+        :param binary: encode the data with numpy in the binary COPY format
+                       instead of rendering it as text. Only for tables with
+                       fixed size types (see pgcopy.TYPES), else text is used.
+        '''
+        if binary:
+            oids = self.column_types(table_name, columns)
+            if not pgcopy.supports(oids):
+                self.logger.warning('Binary COPY not supported for %s, using text' % table_name)
+                binary = False
 
-        
-        
-        cursor = self.__connection.cursor()
-        
         try:
-            if table_name == 'tags':
-                # Truncate the table if the table name is 'tags'
-                cursor.execute(f'TRUNCATE TABLE {table_name};')
-                self.__connection.commit()  # Commit the transaction to truncate the table
-                
-            # Use the copy_from method to load the data into the table
-            cursor.copy_from(buffer, table_name, sep='\t', null='\\N', columns=columns)
-            # Commit the transaction
-            self.__connection.commit()
+            # committed at the end of the block, unless we are in transaction()
+            with self.connection() as connection, connection.cursor() as cursor, \
+                    metrics.timer('dataframe_to_sql', {'table': table_name}):
+                if table_name == 'tags':
+                    # Empty the table if the table name is 'tags' (DELETE does not lock the readers out)
+                    cursor.execute(f'DELETE FROM {table_name};')
+
+                if binary:
+                    self._copy_binary(cursor, df, table_name, columns, oids)
+                else:
+                    self._copy_csv(cursor, df, table_name, columns)
+            metrics.inc('rows_written_total', len(df), {'table': table_name})
         except Exception as e:
-            # Rollback the transaction in case of error
-            self.__connection.rollback()
+            if self.in_transaction():
+                # transaction() rolls back
+                raise
+            # the block has rolled back
             print(f"Error: {e}")
-        finally:
-            # Close the cursor
-            cursor.close()
 
 
 
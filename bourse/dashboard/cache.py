@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Cache of the query results of the dashboard.
+
+  Entries are evicted in LRU order when the total size of the cached
+  dataframes goes over max_bytes, and expire after ttl seconds. The whole
+  cache is dropped when the version of the data changes: the version function
+  is called at most every version_ttl seconds, so that presentation only
+  changes (scale, graph type...) never reach the database.
+
+  >>> calls = []
+  >>> cache = QueryCache(max_bytes=1000, ttl=60)
+  >>> @cache.cached
+  ... def square(x):
+  ...     calls.append(x)
+  ...     return x * x
+  >>> square(3), square(3), calls
+  (9, 9, [3])
+'''
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+import pandas as pd
+
+
+def size_of(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    return sys.getsizeof(value)
+
+
+class QueryCache:
+
+    def __init__(self, max_bytes, ttl, version=None, version_ttl=30):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.__version = version          # function returning the version of the data
+        self.__version_ttl = version_ttl
+        self.__current_version = None
+        self.__version_checked = 0
+        self.__entries = OrderedDict()    # key -> (expiry, size, value)
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def size(self):
+        return self.__size
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+    def check_version(self):
+        '''Drop everything if the data changed since the last check'''
+        now = time.monotonic()
+        if self.__version is None or now - self.__version_checked < self.__version_ttl:
+            return
+        self.__version_checked = now
+        version = self.__version()
+        if version != self.__current_version:
+            self.__current_version = version
+            self.clear()
+
+    def lookup(self, key, default=None):
+        '''Return the value of key if it is cached, else default'''
+        self.check_version()
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.__entries.move_to_end(key)
+                return entry[2]
+        return default
+
+    def get(self, key, compute):
+        '''Return the value of key, calling compute() if it is not cached'''
+        value = self.lookup(key, self)
+        if value is self:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        size = size_of(value)
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__size -= old[1]
+            if size > self.max_bytes:
+                return
+            self.__entries[key] = (time.monotonic() + self.ttl, size, value)
+            self.__size += size
+            while self.__size > self.max_bytes:
+                _, (_, evicted, _) = self.__entries.popitem(last=False)
+                self.__size -= evicted
+
+    def cached(self, function):
+        '''Decorator caching the results of function by its arguments'''
+        @wraps(function)
+        def wrapper(*args):
+            return self.get((function.__name__,) + args, lambda: function(*args))
+        return wrapper
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Data access of the dashboard callbacks, shared by the threads of a worker.
+
+  The queries run with asyncpg in an event loop of their own (a daemon thread)
+  and a callback only waits for the dataframe of its query. A Scheduler bounds
+  the queries running at once: a free slot goes to the waiting query with the
+  lowest priority, METADATA (dropdowns, company names) before SCAN (bars,
+  indicators), and the SCAN queries never take the last slot, so that the
+  dropdowns stay responsive while graphs are computed.
+
+  Queries run in a scope(key), e.g. the graph of a browser tab, are cancelled
+  when a new scope with the same key starts: in this worker by cancelling
+  their task (asyncpg then cancels the statement) and in the other workers
+  with pg_cancel_backend on the application_name of their connection, as
+  sqlrunner does. Their callback gets a Cancelled exception in both cases.
+  A running scope leaves a file in SCOPES_DIR, shared by the workers of the
+  host, so that pg_cancel_backend is only sent while a scope of the key runs
+  in another worker: a graph served from the cache does not query the
+  database.
+
+  The queries use :name parameters, as with SQLAlchemy:
+
+  >>> positional('SELECT * FROM stocks WHERE cid = :cid AND date::date > :start OR cid = :cid', {'cid': 1, 'start': 2})
+  ('SELECT * FROM stocks WHERE cid = $1 AND date::date > $2 OR cid = $1', [1, 2])
+
+  >>> order = []
+  >>> async def query(scheduler, name, priority):
+  ...     async with scheduler.slot(priority):
+  ...         order.append(name)
+  ...         await asyncio.sleep(0.01)
+  >>> async def main():
+  ...     scheduler = Scheduler(2)
+  ...     await asyncio.gather(query(scheduler, 'scan 1', SCAN), query(scheduler, 'scan 2', SCAN),
+  ...                          query(scheduler, 'markets', METADATA), query(scheduler, 'companies', METADATA))
+  >>> asyncio.run(main())
+  >>> order
+  ['scan 1', 'markets', 'companies', 'scan 2']
+'''
+
+import asyncio
+import concurrent.futures
+import contextvars
+import glob
+import heapq
+import itertools
+import os
+import re
+import tempfile
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+import asyncpg
+import pandas as pd
+
+METADATA, SCAN = 0, 1    # priorities, the lowest first
+MAX_CONCURRENCY = 4      # queries running at once in a worker
+TIMEOUT = 120            # seconds
+APPLICATION_NAME = 'bourse-dash-%s'
+# a file <key>.<pid>.<n> for each running scope, in every worker
+SCOPES_DIR = os.path.join(tempfile.gettempdir(), 'bourse-dash-scopes')
+
+Cancelled = concurrent.futures.CancelledError
+
+# key of the scope() of the calling thread
+current_key = contextvars.ContextVar('current_key', default=None)
+
+
+def positional(query, params):
+    '''The query with $n placeholders instead of :name, and its arguments'''
+    names = []
+
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f'${names.index(match.group(1)) + 1}'
+    query = re.sub(r'(?<!:):(\w+)', number, query)
+    return query, [params[name] for name in names]
+
+
+class Scheduler:
+    '''
+    At most limit tasks in slot() at once, and at most limit - 1 of them with
+    a priority above METADATA. A free slot goes to the waiting task with the
+    lowest priority, then to the oldest one.
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.heavy = 0
+        self.__waiting = []    # heap of (priority, order, future)
+        self.__order = itertools.count()
+
+    def can_run(self, priority):
+        return self.running < self.limit and (priority == METADATA or self.heavy < self.limit - 1)
+
+    def take(self, priority):
+        self.running += 1
+        self.heavy += priority != METADATA
+
+    def release(self, priority):
+        self.running -= 1
+        self.heavy -= priority != METADATA
+        while self.__waiting:
+            priority, _, future = self.__waiting[0]
+            if future.cancelled():
+                heapq.heappop(self.__waiting)
+            elif self.can_run(priority):
+                heapq.heappop(self.__waiting)
+                self.take(priority)
+                future.set_result(None)
+            else:
+                break
+
+    @asynccontextmanager
+    async def slot(self, priority=SCAN):
+        # ahead of the waiting tasks of higher priority numbers only
+        if self.can_run(priority) and (not self.__waiting or self.__waiting[0][0] > priority):
+            self.take(priority)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.__waiting, (priority, next(self.__order), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # the slot was given just before the cancellation
+                    self.release(priority)
+                raise
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+
+class DataService:
+
+    def __init__(self, dsn, max_concurrency=MAX_CONCURRENCY, timeout=TIMEOUT):
+        self.dsn = dsn
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.__pid = None
+        self.__loop = None
+        self.__pool = None
+        self.__scheduler = None
+        self.__running = {}    # key -> futures of the queries of this worker
+        self.__scopes = itertools.count()
+        self.__lock = threading.Lock()
+
+    def loop(self):
+        '''The event loop of the queries, started in each process (gunicorn forks its workers)'''
+        with self.__lock:
+            if self.__pid != os.getpid():
+                self.__pid = os.getpid()
+                self.__loop = asyncio.new_event_loop()
+                self.__pool = None
+                self.__scheduler = Scheduler(self.max_concurrency)
+                threading.Thread(target=self.__loop.run_forever, name='dataservice', daemon=True).start()
+            return self.__loop
+
+    async def _pool(self):
+        if self.__pool is None:
+            # a task, awaited by all the first queries; shielded from their cancellation
+            self.__pool = asyncio.ensure_future(asyncpg.create_pool(
+                self.dsn, min_size=0, max_size=self.max_concurrency, command_timeout=self.timeout))
+        return await asyncio.shield(self.__pool)
+
+    async def _fetch(self, query, args, priority, key):
+        async with self.__scheduler.slot(priority):
+            pool = await self._pool()
+            async with pool.acquire() as connection:
+                if key is not None:
+                    # reset when the connection goes back to the pool
+                    await connection.execute("SELECT set_config('application_name', $1, false)",
+                                             APPLICATION_NAME % key)
+                statement = await connection.prepare(query)
+                records = await statement.fetch(*args)
+                columns = [attribute.name for attribute in statement.get_attributes()]
+        return pd.DataFrame([tuple(record) for record in records], columns=columns)
+
+    def fetch(self, query, params=None, priority=SCAN):
+        '''
+        Run query (with :name parameters) and return its rows as a dataframe.
+        Raises Cancelled if a new scope of the same key has started.
+        '''
+        query, args = positional(query, params or {})
+        key = current_key.get()
+        future = asyncio.run_coroutine_threadsafe(self._fetch(query, args, priority, key), self.loop())
+        with self.__lock:
+            self.__running.setdefault(key, set()).add(future)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+        except asyncpg.exceptions.QueryCanceledError:
+            # pg_cancel_backend from the new scope of another worker
+            raise Cancelled() from None
+        finally:
+            with self.__lock:
+                self.__running.get(key, set()).discard(future)
+
+    def cancel(self, key):
+        '''Cancel the queries of key, in this worker and in the others'''
+        with self.__lock:
+            futures = list(self.__running.pop(key, ()))
+        for future in futures:
+            future.cancel()
+        if any(pid != os.getpid() for pid in running_scopes(key)):
+            self.fetch("SELECT pg_cancel_backend(pid) FROM pg_stat_activity "
+                       "WHERE application_name = :name AND pid <> pg_backend_pid()",
+                       {'name': APPLICATION_NAME % key}, priority=METADATA)
+
+    @contextmanager
+    def scope(self, key):
+        '''The queries of the block are cancelled by the next scope(key), None for no cancellation'''
+        marker = None
+        if key is not None:
+            key = re.sub(r'[^0-9a-zA-Z_-]', '', str(key))[:40]
+            self.cancel(key)
+            os.makedirs(SCOPES_DIR, exist_ok=True)
+            marker = os.path.join(SCOPES_DIR, f'{key}.{os.getpid()}.{next(self.__scopes)}')
+            open(marker, 'w').close()
+        token = current_key.set(key)
+        try:
+            yield
+        finally:
+            current_key.reset(token)
+            if marker is not None:
+                os.remove(marker)
+
+
+def running_scopes(key):
+    '''The pids of the workers running a scope of key. The files of the workers
+    which died in a scope are removed.'''
+    pids = []
+    for path in glob.glob(os.path.join(SCOPES_DIR, f'{key}.*')):
+        pid = int(path.rsplit('.', 2)[1])
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass    # removed by another worker
+            continue
+        except PermissionError:
+            pass
+        pids.append(pid)
+    return pids
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Visual downsampling of the line traces.
+
+  Largest-Triangle-Three-Buckets keeps the first and the last point and, in
+  each of the max_points - 2 buckets in between, the point forming the largest
+  triangle with the point kept in the previous bucket and the average of the
+  next bucket. The shape of the line is kept with a fraction of the points.
+
+  cf Sveinn Steinarsson, Downsampling Time Series for Visual Representation, 2013
+
+  >>> lttb(range(10), [0, 1, 0, 0, 5, 0, 0, 0, -10, 0], 4)
+  array([0, 4, 8, 9])
+'''
+
+import numpy as np
+import pandas as pd
+
+# Points drawn per pixel of the graph width
+POINTS_PER_PIXEL = 2
+# Graph width used before the browser sent the real one
+DEFAULT_GRAPH_WIDTH = 1200
+
+
+def max_points(graph_width):
+    return POINTS_PER_PIXEL * (graph_width or DEFAULT_GRAPH_WIDTH)
+
+def as_float(values):
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = values.astype('int64')
+    return values.to_numpy(dtype=float)
+
+def lttb(x, y, max_points):
+    '''Return the (sorted) indices of the points to keep'''
+    n = len(y)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+    x, y = as_float(x), as_float(y)
+
+    # max_points - 2 buckets over the points 1 .. n-2
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    starts, ends = edges[:-1], edges[1:]
+    sizes = ends - starts
+    average_x = np.add.reduceat(x[:n - 1], starts) / sizes
+    average_y = np.add.reduceat(y[:n - 1], starts) / sizes
+    # the "next bucket" of the last bucket is the last point
+    average_x = np.append(average_x[1:], x[-1])
+    average_y = np.append(average_y[1:], y[-1])
+
+    keep = np.empty(max_points, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        bx, by = x[start:end], y[start:end]
+        area = np.abs((x[a] - average_x[i]) * (by - y[a]) - (x[a] - bx) * (average_y[i] - y[a]))
+        a = start + np.argmax(area)
+        keep[i + 1] = a
+    return keep
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
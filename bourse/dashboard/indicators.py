@@ -0,0 +1 @@
+../analyzer/indicators.py
\ No newline at end of file
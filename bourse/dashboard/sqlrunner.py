@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Bounded execution of the ad-hoc SQL queries of the dashboard.
+
+  A query runs in a read-only transaction with a statement_timeout and its
+  rows are fetched by chunks from a server-side cursor until max_rows rows or
+  about max_bytes bytes, so that a SELECT * FROM stocks cannot load the
+  hypertable in the dashboard. The query is sent as a subquery, so that it
+  must return rows (SELECT, WITH, VALUES or TABLE).
+
+  psycopg2 sends it with the simple query protocol, which runs every statement
+  of the text: a query such as 'SELECT 1) q; COMMIT; DELETE ...' would close
+  the subquery and run its other statements after the read-only transaction.
+  statement() rejects a ; outside the strings, quoted identifiers and
+  comments, and the sessions of create_engine() are read only by default. A
+  role with only SELECT privileges, in the URI given to create_engine(), is
+  the strongest guard.
+
+  Each run has a token put in the application_name of its backend: cancel()
+  finds the backend with it and calls pg_cancel_backend, from any worker.
+
+  >>> wrap('SELECT 1;  ')
+  'SELECT * FROM (\\nSELECT 1\\n) AS query'
+  >>> statement("SELECT ';' AS a, $x$;$x$ AS \\"b;\\" /* ; */ ; -- end")
+  'SELECT \\';\\' AS a, $x$;$x$ AS "b;" /* ; */ '
+  >>> statement('SELECT 1) q; COMMIT; DELETE FROM stocks; SELECT * FROM (SELECT 1')
+  Traceback (most recent call last):
+  ...
+  ValueError: Only one statement can be run
+  >>> statement("SELECT E'\\\\'' ; DELETE FROM stocks; '")
+  Traceback (most recent call last):
+  ...
+  ValueError: Only one statement can be run
+'''
+
+import re
+
+import time
+
+import pandas as pd
+import psycopg2.errors
+import sqlalchemy
+
+STATEMENT_TIMEOUT = 30      # seconds
+MAX_ROWS = 10000
+MAX_BYTES = 8 * 2**20       # approximated by the length of the values as text
+FETCH_ROWS = 1000
+APPLICATION_NAME = 'bourse-sql-%s'
+
+
+def create_engine(uri):
+    '''An engine for run() and cancel() whose transactions are read only by default'''
+    return sqlalchemy.create_engine(uri, connect_args={'options': '-c default_transaction_read_only=on'})
+
+def is_identifier(char):
+    return char.isalnum() or char in '_$'
+
+def statement(query):
+    '''
+    The query up to its final ;, if any. Raises ValueError if something else
+    than spaces and comments follows a ; outside the strings, the quoted
+    identifiers and the comments.
+    '''
+    i, n, end = 0, len(query), None
+    while i < n:
+        char = query[i]
+        if query.startswith('--', i):
+            i = query.find('\n', i)
+            i = n if i < 0 else i
+            continue
+        if query.startswith('/*', i):
+            # the block comments of PostgreSQL nest
+            depth, i = 1, i + 2
+            while depth:
+                match = re.compile(r'/\*|\*/').search(query, i)
+                if match is None:
+                    raise ValueError('Unterminated comment')
+                depth += 1 if match.group() == '/*' else -1
+                i = match.end()
+            continue
+        if end is not None and not char.isspace():
+            raise ValueError('Only one statement can be run')
+        if char in '\'"':
+            # a backslash escapes the quote in E'...' only, a doubled quote in all of them
+            escapes = (char == "'" and query[i - 1:i] in ('e', 'E')
+                       and not is_identifier(query[i - 2:i - 1] or ' '))
+            i += 1
+            while True:
+                if i >= n:
+                    raise ValueError('Unterminated string')
+                if escapes and query[i] == '\\':
+                    i += 2
+                elif query.startswith(char * 2, i):
+                    i += 2
+                elif query[i] == char:
+                    break
+                else:
+                    i += 1
+        elif char == '$' and not is_identifier(query[i - 1:i] or ' '):
+            # $tag$ ... $tag$, $1 is a parameter
+            match = re.compile(r'\$([^\W\d]\w*)?\$').match(query, i)
+            if match is not None:
+                i = query.find(match.group(), match.end())
+                if i < 0:
+                    raise ValueError('Unterminated dollar-quoted string')
+                i += len(match.group()) - 1
+        elif char == ';':
+            end = i
+        i += 1
+    return query if end is None else query[:end]
+
+def wrap(query):
+    '''The query as a subquery, the new lines keep a final -- comment inside'''
+    query = statement(query.strip()).strip()
+    return f'SELECT * FROM (\n{query}\n) AS query'
+
+def run(engine, query, token, timeout=STATEMENT_TIMEOUT, max_rows=MAX_ROWS, max_bytes=MAX_BYTES):
+    '''
+    Return the first rows of query as a dataframe, the reason why the rows
+    were truncated ('rows', 'bytes' or None) and the time taken.
+    Database errors, the timeout and the cancellation raise psycopg2 errors.
+    '''
+    start = time.perf_counter()
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SET TRANSACTION READ ONLY;')
+        cursor.execute("SELECT set_config('statement_timeout', %s, true), set_config('application_name', %s, true);",
+                       (f'{int(timeout * 1000)}', APPLICATION_NAME % token))
+        cursor.close()
+
+        cursor = connection.cursor(name=f'sqlrunner_{token}')
+        cursor.execute(wrap(query))
+        rows, size, truncated = [], 0, None
+        while len(rows) <= max_rows:
+            chunk = cursor.fetchmany(FETCH_ROWS)
+            if not chunk:
+                break
+            rows.extend(chunk)
+            size += sum(len(str(value)) for row in chunk for value in row)
+            if size > max_bytes:
+                truncated = 'bytes'
+                break
+        if len(rows) > max_rows:
+            rows, truncated = rows[:max_rows], 'rows'
+        columns = [column.name for column in cursor.description]
+        cursor.close()
+    finally:
+        connection.rollback()
+        connection.close()
+    return pd.DataFrame(rows, columns=columns), truncated, time.perf_counter() - start
+
+def cancel(engine, token):
+    '''Cancel the query of token if it is running, return True if it was'''
+    query = "SELECT pg_cancel_backend(pid) FROM pg_stat_activity WHERE application_name = :name"
+    with engine.connect() as connection:
+        result = connection.execute(sqlalchemy.text(query), {'name': APPLICATION_NAME % token}).fetchall()
+    return any(row[0] for row in result)
+
+def describe(error):
+    if isinstance(error, psycopg2.errors.QueryCanceled):
+        return f'Query canceled (cancel button or timeout of {STATEMENT_TIMEOUT} s)'
+    return str(error)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()